@@ -0,0 +1,617 @@
+"""Persistent caches shared across tasks, runs and worker processes."""
+
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from webthinker.config import (BLOB_MEMORY_BYTES, FAILURE_BACKOFF_BASE,
+                               FAILURE_BACKOFF_MAX, FAILURE_CACHE_PATH,
+                               HOST_FAILURE_THRESHOLD, JUDGMENT_CACHE_PATH,
+                               PAGE_CACHE_MAX_BYTES, PAGE_CACHE_PATH,
+                               PAGE_CACHE_TOUCH_INTERVAL, PAGE_CACHE_TTL,
+                               SEARCH_CACHE_ONLY, SEARCH_CACHE_PATH,
+                               SEARCH_CACHE_TTL)
+
+logger = logging.getLogger("webthinker.cache")
+
+
+def content_digest(content: str) -> str:
+    """Digest of a page content."""
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def canonical_url(url: str) -> str:
+    """Canonicalize url as cache key."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rpartition(":")[2]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rpartition(":")[0]
+    path = parts.path or "/"
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+class SQLiteStore:
+    """Base class of the SQLite backed stores.
+
+    Each thread owns its own connection. The database runs in WAL mode so
+    that several worker processes can read and write it concurrently.
+    """
+
+    schema = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn.executescript(self.schema)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction, holding the database lock from the start."""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class PageStore(SQLiteStore):
+    """Persistent page contents keyed by canonical url.
+
+    Contents are stored as compressed markdown with their fetch time and
+    their serialized sentence index, looked up by content digest.
+    Entries expire after ``ttl`` seconds, and the least recently used
+    entries are evicted once the store exceeds ``max_bytes``. The total
+    size is kept up to date by triggers, and reads only record their
+    access times in memory until the next write, or at most every
+    ``touch_interval`` seconds.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS pages ("
+        "url TEXT PRIMARY KEY, content BLOB, size INTEGER, "
+        "fetched_at REAL, accessed_at REAL, digest TEXT, sentence_index BLOB);"
+        "CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at);"
+        "CREATE INDEX IF NOT EXISTS pages_fetched_at ON pages (fetched_at);"
+        "CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest);"
+        "CREATE TABLE IF NOT EXISTS pages_size ("
+        "id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER);"
+        "INSERT OR IGNORE INTO pages_size SELECT 0, COALESCE(SUM(size), 0) FROM pages;"
+        "CREATE TRIGGER IF NOT EXISTS pages_insert AFTER INSERT ON pages BEGIN "
+        "UPDATE pages_size SET total = total + NEW.size; END;"
+        "CREATE TRIGGER IF NOT EXISTS pages_delete AFTER DELETE ON pages BEGIN "
+        "UPDATE pages_size SET total = total - OLD.size; END;"
+        "CREATE TRIGGER IF NOT EXISTS pages_update AFTER UPDATE OF size ON pages BEGIN "
+        "UPDATE pages_size SET total = total + NEW.size - OLD.size; END;"
+    )
+
+    def __init__(
+        self,
+        path: str = PAGE_CACHE_PATH,
+        ttl: float = PAGE_CACHE_TTL,
+        max_bytes: int = PAGE_CACHE_MAX_BYTES,
+        touch_interval: float = PAGE_CACHE_TOUCH_INTERVAL,
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._touched: Dict[str, float] = {}
+        self._touched_lock = threading.Lock()
+        self._last_touch = time.time()
+        super().__init__(path)
+
+    def get(self, url: str) -> Optional[str]:
+        """Get page content, None if missing or expired."""
+        return self.get_many([url]).get(url)
+
+    def get_many(self, urls: List[str]) -> Dict[str, str]:
+        """Get contents of the cached pages among urls."""
+        keys = {url: canonical_url(url) for url in urls}
+        if not keys:
+            return {}
+        now = time.time()
+        unique_keys = list(dict.fromkeys(keys.values()))
+        placeholders = ",".join("?" * len(unique_keys))
+        rows = self.conn.execute(
+            f"SELECT url, content FROM pages "
+            f"WHERE url IN ({placeholders}) AND fetched_at > ?",
+            [*unique_keys, now - self.ttl],
+        ).fetchall()
+        if not rows:
+            return {}
+        self._touch([key for key, _ in rows], now)
+        contents = {
+            key: zlib.decompress(content).decode("utf-8")
+            for key, content in rows
+        }
+        return {
+            url: contents[key]
+            for url, key in keys.items() if key in contents
+        }
+
+    def get_sentence_index(self, digest: str) -> Optional[bytes]:
+        """Get the serialized sentence index of a page content."""
+        row = self.conn.execute(
+            "SELECT sentence_index FROM pages "
+            "WHERE digest = ? AND sentence_index IS NOT NULL LIMIT 1",
+            (digest,),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_by_digests(self, digests: List[str]) -> Dict[str, str]:
+        """Get stored contents by digest, expired or not."""
+        if not digests:
+            return {}
+        placeholders = ",".join("?" * len(digests))
+        rows = self.conn.execute(
+            f"SELECT digest, content FROM pages WHERE digest IN ({placeholders}) "
+            f"GROUP BY digest",
+            list(digests),
+        ).fetchall()
+        return {
+            digest: zlib.decompress(content).decode("utf-8")
+            for digest, content in rows
+        }
+
+    def put(self, url: str, content: str, sentence_index: Optional[bytes] = None):
+        """Store page content."""
+        self.put_many({url: content}, {url: sentence_index})
+
+    def put_many(
+        self,
+        contents: Dict[str, str],
+        sentence_indexes: Optional[Dict[str, Optional[bytes]]] = None,
+    ):
+        """Store page contents and evict old entries if necessary."""
+        if not contents:
+            return
+        sentence_indexes = sentence_indexes or {}
+        now = time.time()
+        rows = []
+        for url, content in contents.items():
+            data = zlib.compress(content.encode("utf-8"))
+            sentence_index = sentence_indexes.get(url)
+            size = len(data) + len(sentence_index or b"")
+            rows.append((
+                canonical_url(url), data, size, now, now,
+                content_digest(content), sentence_index,
+            ))
+        touched = self._pop_touched()
+        with self.transaction() as conn:
+            self._write_touched(conn, touched)
+            # Upsert rather than replace, so that the update trigger fires
+            conn.executemany(
+                "INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET content = excluded.content, "
+                "size = excluded.size, fetched_at = excluded.fetched_at, "
+                "accessed_at = excluded.accessed_at, digest = excluded.digest, "
+                "sentence_index = excluded.sentence_index",
+                rows,
+            )
+            self._evict(conn, now)
+
+    def _touch(self, keys: List[str], now: float):
+        """Record access times, writing them once the touch interval elapsed."""
+        with self._touched_lock:
+            self._touched.update(dict.fromkeys(keys, now))
+            if now - self._last_touch < self.touch_interval:
+                return
+        touched = self._pop_touched()
+        with self.transaction() as conn:
+            self._write_touched(conn, touched)
+
+    def _pop_touched(self) -> Dict[str, float]:
+        """Take the access times not written yet."""
+        with self._touched_lock:
+            touched, self._touched = self._touched, {}
+            self._last_touch = time.time()
+        return touched
+
+    @staticmethod
+    def _write_touched(conn: sqlite3.Connection, touched: Dict[str, float]):
+        """Write access times, never moving them back."""
+        conn.executemany(
+            "UPDATE pages SET accessed_at = MAX(accessed_at, ?) WHERE url = ?",
+            [(accessed_at, key) for key, accessed_at in touched.items()],
+        )
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """Drop expired entries, then least recently used ones."""
+        conn.execute("DELETE FROM pages WHERE fetched_at <= ?", (now - self.ttl,))
+        total = conn.execute("SELECT total FROM pages_size").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        # Walk the access time index only as far as needed
+        cursor = conn.execute("SELECT url, size FROM pages ORDER BY accessed_at")
+        for url, size in cursor:
+            if total <= self.max_bytes:
+                break
+            evicted.append((url,))
+            total -= size
+        cursor.close()
+        conn.executemany("DELETE FROM pages WHERE url = ?", evicted)
+
+
+class BlobStore:
+    """Content-addressed view of the page contents.
+
+    Graph states only keep the digests of page contents, which are loaded
+    lazily through an in-process LRU cache bounded by ``memory_bytes``.
+    Contents are persisted once, in their page store rows, so they are
+    evicted along with their pages. Contents that were never stored, such
+    as failed or replayed pages, only live in memory.
+    """
+
+    def __init__(
+        self,
+        page_store: PageStore,
+        memory_bytes: int = BLOB_MEMORY_BYTES,
+    ):
+        self.page_store = page_store
+        self.memory_bytes = memory_bytes
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._memory_size = 0
+        self._memory_lock = threading.Lock()
+
+    def get(self, digest: str) -> Optional[str]:
+        """Get the content of a digest, None if it is gone."""
+        return self.get_many([digest]).get(digest)
+
+    def get_many(self, digests: List[str]) -> Dict[str, str]:
+        """Get the contents of the digests still in memory or stored."""
+        contents = {}
+        with self._memory_lock:
+            for digest in dict.fromkeys(digests):
+                if digest in self._memory:
+                    self._memory.move_to_end(digest)
+                    contents[digest] = self._memory[digest]
+        missing = [digest for digest in dict.fromkeys(digests) if digest not in contents]
+        if missing:
+            loaded = self.page_store.get_by_digests(missing)
+            self._remember(loaded)
+            contents.update(loaded)
+        return contents
+
+    def put_many(self, contents: Dict[str, str]) -> Dict[str, str]:
+        """Keep contents in memory, returning the digest of each key."""
+        digests = {key: content_digest(content) for key, content in contents.items()}
+        self._remember(dict(zip(digests.values(), contents.values())))
+        return digests
+
+    def _remember(self, blobs: Dict[str, str]):
+        """Keep contents in memory, evicting least recently used ones."""
+        with self._memory_lock:
+            for digest, content in blobs.items():
+                if digest not in self._memory:
+                    self._memory_size += len(content)
+                self._memory[digest] = content
+                self._memory.move_to_end(digest)
+            while self._memory_size > self.memory_bytes and self._memory:
+                _, content = self._memory.popitem(last=False)
+                self._memory_size -= len(content)
+
+
+class SearchCache(SQLiteStore):
+    """Persistent search results keyed by (provider, normalized query, k).
+
+    In cache-only mode, misses return no results instead of calling the
+    search API, so that reruns never pay for searches.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS searches ("
+        "key TEXT PRIMARY KEY, results TEXT, created_at REAL);"
+    )
+
+    def __init__(
+        self,
+        path: str = SEARCH_CACHE_PATH,
+        ttl: float = SEARCH_CACHE_TTL,
+        cache_only: bool = SEARCH_CACHE_ONLY,
+    ):
+        self.ttl = ttl
+        self.cache_only = cache_only
+        self.stats = {"hits": 0, "misses": 0}
+        self._stats_lock = threading.Lock()
+        super().__init__(path)
+
+    @staticmethod
+    def make_key(provider: str, query: str, k: int) -> str:
+        """Build cache key."""
+        normalized_query = " ".join(query.lower().split())
+        return json.dumps([provider, normalized_query, k], ensure_ascii=False)
+
+    def get(self, provider: str, query: str, k: int) -> Optional[List[Dict]]:
+        """Get search results, None if missing or expired."""
+        row = self.conn.execute(
+            "SELECT results FROM searches WHERE key = ? AND created_at > ?",
+            (self.make_key(provider, query, k), time.time() - self.ttl),
+        ).fetchone()
+        with self._stats_lock:
+            self.stats["hits" if row else "misses"] += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, provider: str, query: str, k: int, results: List[Dict]):
+        """Store search results."""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                (
+                    self.make_key(provider, query, k),
+                    json.dumps(results, ensure_ascii=False),
+                    time.time(),
+                ),
+            )
+
+
+class JudgmentCache(SQLiteStore):
+    """Persistent LLM judgments keyed by a hash of the prompt and the model.
+
+    Re-evaluating unchanged results makes no API calls, and only changed
+    predictions are judged again.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS judgments ("
+        "key TEXT PRIMARY KEY, judgment TEXT, created_at REAL);"
+    )
+
+    def __init__(self, path: str = JUDGMENT_CACHE_PATH):
+        self.stats = {"hits": 0, "misses": 0}
+        self._stats_lock = threading.Lock()
+        super().__init__(path)
+
+    @staticmethod
+    def make_key(prompt: str, model_config: str) -> str:
+        """Hash the judge prompt and the model config into a key."""
+        data = json.dumps([model_config, prompt], ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Get the cached judgments among keys."""
+        unique_keys = list(dict.fromkeys(keys))
+        judgments = {}
+        # Stay below the SQLite limit of query parameters
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            judgments.update(self.conn.execute(
+                f"SELECT key, judgment FROM judgments WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall())
+        with self._stats_lock:
+            self.stats["hits"] += len(judgments)
+            self.stats["misses"] += len(unique_keys) - len(judgments)
+        return judgments
+
+    def put_many(self, judgments: Dict[str, str]):
+        """Store judgments."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO judgments VALUES (?, ?, ?)",
+                [(key, judgment, now) for key, judgment in judgments.items()],
+            )
+
+
+class FailureCache(SQLiteStore):
+    """Negative cache of unfetchable urls and hosts.
+
+    A failed url is not retried before an exponentially growing backoff.
+    A host opens its circuit once ``threshold`` distinct urls failed in a
+    row, and all its urls are skipped until the host backoff expires.
+    Failing the same url again does not count against its host. Any
+    success resets the url and closes the circuit of its host.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS failures ("
+        "key TEXT PRIMARY KEY, failures INTEGER, retry_at REAL);"
+    )
+
+    def __init__(
+        self,
+        path: str = FAILURE_CACHE_PATH,
+        backoff_base: float = FAILURE_BACKOFF_BASE,
+        backoff_max: float = FAILURE_BACKOFF_MAX,
+        threshold: int = HOST_FAILURE_THRESHOLD,
+    ):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.threshold = threshold
+        super().__init__(path)
+
+    @staticmethod
+    def url_key(url: str) -> str:
+        """Key of a url."""
+        return f"url:{canonical_url(url)}"
+
+    @staticmethod
+    def host_key(url: str) -> str:
+        """Key of the host of a url."""
+        return f"host:{urlsplit(url).hostname or ''}"
+
+    def backoff(self, failures: int) -> float:
+        """Backoff after a number of failures."""
+        return min(self.backoff_base * 2 ** (failures - 1), self.backoff_max)
+
+    def blocked(self, urls: List[str]) -> List[str]:
+        """Get urls that should not be fetched now."""
+        keys = {url: (self.url_key(url), self.host_key(url)) for url in urls}
+        if not keys:
+            return []
+        all_keys = list({key for pair in keys.values() for key in pair})
+        placeholders = ",".join("?" * len(all_keys))
+        blocked_keys = {
+            row[0]
+            for row in self.conn.execute(
+                f"SELECT key FROM failures "
+                f"WHERE key IN ({placeholders}) AND retry_at > ?",
+                [*all_keys, time.time()],
+            )
+        }
+        return [
+            url for url, (url_key, host_key) in keys.items()
+            if url_key in blocked_keys or host_key in blocked_keys
+        ]
+
+    def update(self, contents: Dict[str, str], failed: str):
+        """Track failures and successes of fetched urls."""
+        if not contents:
+            return
+        now = time.time()
+        with self.transaction() as conn:
+            for url, content in contents.items():
+                url_key, host_key = self.url_key(url), self.host_key(url)
+                if content != failed:
+                    conn.execute(
+                        "DELETE FROM failures WHERE key IN (?, ?)",
+                        (url_key, host_key),
+                    )
+                    continue
+                url_failures = self._increase(conn, url_key)
+                self._set_retry_at(conn, url_key, now + self.backoff(url_failures))
+                if url_failures > 1:
+                    continue
+                host_failures = self._increase(conn, host_key)
+                if host_failures >= self.threshold:
+                    backoff = self.backoff(host_failures - self.threshold + 1)
+                    self._set_retry_at(conn, host_key, now + backoff)
+
+    @staticmethod
+    def _increase(conn: sqlite3.Connection, key: str) -> int:
+        """Increase the failure counter of a key."""
+        conn.execute(
+            "INSERT INTO failures VALUES (?, 1, 0) "
+            "ON CONFLICT (key) DO UPDATE SET failures = failures + 1",
+            (key,),
+        )
+        return conn.execute(
+            "SELECT failures FROM failures WHERE key = ?", (key,),
+        ).fetchone()[0]
+
+    @staticmethod
+    def _set_retry_at(conn: sqlite3.Connection, key: str, retry_at: float):
+        """Set the earliest retry time of a key."""
+        conn.execute(
+            "UPDATE failures SET retry_at = ? WHERE key = ?", (retry_at, key),
+        )
+
+
+def cached_search(provider: str) -> Callable:
+    """Decorate an async search function to read through the search cache."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(query: str, max_results: int) -> List[Dict[str, str]]:
+            search_cache = get_search_cache()
+            results = await asyncio.to_thread(
+                search_cache.get, provider, query, max_results,
+            )
+            if results is not None:
+                return results
+            if search_cache.cache_only:
+                logger.warning("Search cache miss in cache-only mode: %s", query)
+                return []
+            results = await func(query, max_results)
+            # Empty results are mostly API errors, do not cache them
+            if results:
+                await asyncio.to_thread(
+                    search_cache.put, provider, query, max_results, results,
+                )
+            return results
+        return wrapper
+    return decorator
+
+
+_PAGE_STORE: Optional[PageStore] = None
+_PAGE_STORE_LOCK = threading.Lock()
+
+
+def get_page_store() -> PageStore:
+    """Get the process-wide page store."""
+    global _PAGE_STORE  # pylint: disable=global-statement
+    with _PAGE_STORE_LOCK:
+        if _PAGE_STORE is None:
+            _PAGE_STORE = PageStore()
+    return _PAGE_STORE
+
+
+_BLOB_STORE: Optional[BlobStore] = None
+_BLOB_STORE_LOCK = threading.Lock()
+
+
+def get_blob_store() -> BlobStore:
+    """Get the process-wide blob store."""
+    global _BLOB_STORE  # pylint: disable=global-statement
+    with _BLOB_STORE_LOCK:
+        if _BLOB_STORE is None:
+            _BLOB_STORE = BlobStore(get_page_store())
+    return _BLOB_STORE
+
+
+_JUDGMENT_CACHE: Optional[JudgmentCache] = None
+_JUDGMENT_CACHE_LOCK = threading.Lock()
+
+
+def get_judgment_cache() -> JudgmentCache:
+    """Get the process-wide judgment cache."""
+    global _JUDGMENT_CACHE  # pylint: disable=global-statement
+    with _JUDGMENT_CACHE_LOCK:
+        if _JUDGMENT_CACHE is None:
+            _JUDGMENT_CACHE = JudgmentCache()
+    return _JUDGMENT_CACHE
+
+
+_SEARCH_CACHE: Optional[SearchCache] = None
+_SEARCH_CACHE_LOCK = threading.Lock()
+
+
+def get_search_cache() -> SearchCache:
+    """Get the process-wide search cache."""
+    global _SEARCH_CACHE    # pylint: disable=global-statement
+    with _SEARCH_CACHE_LOCK:
+        if _SEARCH_CACHE is None:
+            _SEARCH_CACHE = SearchCache()
+    return _SEARCH_CACHE
+
+
+_FAILURE_CACHE: Optional[FailureCache] = None
+_FAILURE_CACHE_LOCK = threading.Lock()
+
+
+def get_failure_cache() -> FailureCache:
+    """Get the process-wide failure cache."""
+    global _FAILURE_CACHE   # pylint: disable=global-statement
+    with _FAILURE_CACHE_LOCK:
+        if _FAILURE_CACHE is None:
+            _FAILURE_CACHE = FailureCache()
+    return _FAILURE_CACHE
@@ -4,6 +4,7 @@ from typing import Literal
 
 # Paths
 NLTK_DATA_PATH = "./thirdparty/nltk_data"
+CACHE_DIR = "./cache"
 
 # Model
 BASEURL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
@@ -16,15 +17,60 @@ TEMPERATURE = 0.7
 TOP_P = 0.8
 TOP_K = 20
 REPETITION_PENALTY = 1.05
+LLM_MAX_CONCURRENCY = 32
+LLM_MAX_CONNECTIONS = 64
+LLM_KEEPALIVE_EXPIRY = 120
+LLM_TIMEOUT = 600
 
 # Supervisor
 MAX_INTERACTIONS = 20
 MAX_OUTPUT_RETRY = 3
+HISTORY_RENDERER_CACHE_SIZE = 1024
+SUPERVISOR_TOKEN_BUDGET = 24000
+SUPERVISOR_KEEP_RECENT = 6
+COMPACTED_TOOL_OUTPUT_CHARS = 500
+
+# Crawler
+CRAWLER_POOL_SIZE = 4
+CRAWLER_MAX_PAGES = 50
+CRAWLER_PAGE_TIMEOUT = 60
+FETCH_MAX_CONCURRENCY = 16
+FETCH_MAX_PER_HOST = 2
+FETCH_DEADLINE = 120
+HTTP_FETCH_TIMEOUT = 15
+HTTP_MIN_CHARS = 500
+HTTP_MAX_BYTES = 20 * 1024 ** 2
+
+# Page cache
+PAGE_CACHE_PATH = f"{CACHE_DIR}/pages.sqlite"
+PAGE_CACHE_TTL = 7 * 24 * 3600
+PAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+PAGE_CACHE_TOUCH_INTERVAL = 60
+SENTENCE_INDEX_CACHE_SIZE = 256
+
+# Blob store
+BLOB_MEMORY_BYTES = 256 * 1024 ** 2
+
+# Failure cache
+FAILURE_CACHE_PATH = f"{CACHE_DIR}/failures.sqlite"
+FAILURE_BACKOFF_BASE = 600
+FAILURE_BACKOFF_MAX = 7 * 24 * 3600
+HOST_FAILURE_THRESHOLD = 3
+
+# Work queue
+QUEUE_LEASE = 600
+QUEUE_MAX_ATTEMPTS = 3
 
 # Search Query Tool
 SEARCH_TOOL: Literal["tavily", "google"] = "google"
 SEARCH_TOP_K = 10
 MAX_SEARCH_LIMIT = 20
+RETRIEVER_CACHE_SIZE = 64
+
+# Search cache
+SEARCH_CACHE_PATH = f"{CACHE_DIR}/searches.sqlite"
+SEARCH_CACHE_TTL = 30 * 24 * 3600
+SEARCH_CACHE_ONLY = False
 
 # Evaluation
 GROUP_KEYS = [
@@ -33,3 +79,9 @@ GROUP_KEYS = [
     "category", # HLE
     "domain",   # WebWalkerQA
 ]
+JUDGE_MAX_CONCURRENCY = 32
+JUDGE_BATCH_ROUNDS = 4
+JUDGE_MAX_BACKOFF = 60
+JUDGE_MAX_RATE_LIMIT_RETRIES = 8
+JUDGMENT_CACHE_PATH = f"{CACHE_DIR}/judgments.sqlite"
+PERFORMANCE_FLUSH_INTERVAL = 30
@@ -0,0 +1,390 @@
+"""Shared crawler pool."""
+
+import asyncio
+import atexit
+import concurrent.futures
+import io
+import logging
+import threading
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
+from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
+from pypdf import PdfReader
+
+from webthinker.config import (CRAWLER_MAX_PAGES, CRAWLER_PAGE_TIMEOUT,
+                               CRAWLER_POOL_SIZE, FETCH_DEADLINE,
+                               FETCH_MAX_CONCURRENCY, FETCH_MAX_PER_HOST,
+                               HTTP_FETCH_TIMEOUT, HTTP_MAX_BYTES,
+                               HTTP_MIN_CHARS)
+
+FETCH_FAILED = "Can not fetch the page content."
+
+HTTP_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/pdf;q=0.9,*/*;q=0.8",
+}
+
+# Non-html content types read by the HTTP fetch, unknown ones may be pdfs
+HTTP_CONTENT_TYPES = (
+    "",
+    "application/octet-stream",
+    "application/pdf",
+    "text/markdown",
+    "text/plain",
+)
+
+JS_MARKERS = (
+    "enable javascript",
+    "javascript is disabled",
+    "javascript is required",
+    "requires javascript",
+    "you need to enable javascript",
+)
+
+logger = logging.getLogger("webthinker.crawler")
+
+
+def html_to_markdown(html: str, base_url: str = "") -> str:
+    """Convert html into markdown as the crawler does."""
+    result = DefaultMarkdownGenerator().generate_markdown(
+        input_html=html,
+        base_url=base_url,
+        citations=False,
+    )
+    return result.raw_markdown.strip()
+
+
+def pdf_to_markdown(data: bytes) -> str:
+    """Extract the text of a pdf file."""
+    reader = PdfReader(io.BytesIO(data))
+    return "\n\n".join(
+        (page.extract_text() or "").strip() for page in reader.pages
+    ).strip()
+
+
+def looks_js_rendered(html: str) -> bool:
+    """Check whether a page needs javascript to show its content."""
+    lowered = html.lower()
+    return any(marker in lowered for marker in JS_MARKERS)
+
+
+class CrawlerPool:
+    """Process-wide pool of warm crawl4ai browsers.
+
+    The pool owns a background event loop, so that browsers outlive a single
+    ``asyncio.run`` and can be shared by the event loops of all callers.
+    Each browser is recycled after ``max_pages`` pages and restarted when
+    its health check fails or a crawl crashes. Batches of pages are fetched
+    concurrently, bounded by a global and a per-host limit.
+
+    Pages are first fetched with a pooled HTTP client, and only escalated
+    to a browser when they look javascript rendered, come back empty or
+    have an unsupported content type.
+    """
+
+    def __init__(
+        self,
+        size: int = CRAWLER_POOL_SIZE,
+        max_pages: int = CRAWLER_MAX_PAGES,
+        page_timeout: float = CRAWLER_PAGE_TIMEOUT,
+        max_concurrency: int = FETCH_MAX_CONCURRENCY,
+        max_per_host: int = FETCH_MAX_PER_HOST,
+    ):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.browser_config = BrowserConfig(
+            verbose=True,
+            text_mode=True,
+        )
+        self.run_config = CrawlerRunConfig(
+            verbose=True,
+            scan_full_page=True,
+            page_timeout=int(page_timeout * 1000),
+            # exclude_external_links=True,
+        )
+        self.stats = {"http": 0, "browser": 0, "failed": 0, "restarts": 0}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready: Optional[concurrent.futures.Future] = None
+        self._starting: Optional[asyncio.Task] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._http: Optional[httpx.AsyncClient] = None
+        self._global_limit: Optional[asyncio.Semaphore] = None
+        # Per-host limits and their numbers of users, dropped once unused
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        self._host_users: Dict[str, int] = {}
+        # Pages crawled by every started browser, idle or checked out
+        self._pages: Dict[AsyncWebCrawler, int] = {}
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Event loop of the pool, started on first use."""
+        with self._lock:
+            if self._loop is None or not self._thread.is_alive():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=loop.run_forever,
+                    name="webthinker-crawler",
+                    daemon=True,
+                )
+                thread.start()
+                self._loop, self._thread = loop, thread
+                # Never wait for the warm-up here, callers may run a loop
+                self._ready = asyncio.run_coroutine_threadsafe(self._warm_up(), loop)
+        return self._loop
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Schedule a coroutine on the pool loop, after its warm-up."""
+        loop = self.loop
+        return asyncio.run_coroutine_threadsafe(self._when_ready(coro), loop)
+
+    async def _when_ready(self, coro):
+        """Run a coroutine once the pool is warmed up."""
+        await asyncio.wrap_future(self._ready)
+        return await coro
+
+    async def afetch_many(
+        self,
+        urls: List[str],
+        deadline: float = FETCH_DEADLINE,
+    ) -> Dict[str, Optional[str]]:
+        """Fetch webpages concurrently from any event loop."""
+        return await asyncio.wrap_future(self.submit(self.crawl_many(urls, deadline)))
+
+    async def crawl_many(
+        self,
+        urls: List[str],
+        deadline: float = FETCH_DEADLINE,
+    ) -> Dict[str, Optional[str]]:
+        """Fetch webpages concurrently. Must run on the pool loop.
+
+        Pages not fetched before the deadline are cancelled and returned as
+        None, as their hosts did not necessarily fail. The returned dict
+        follows the order of ``urls``.
+        """
+        tasks = {
+            url: asyncio.ensure_future(self._fetch_limited(url))
+            for url in dict.fromkeys(urls)
+        }
+        if not tasks:
+            return {}
+        done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning("%d pages exceeded the fetch deadline.", len(pending))
+            await asyncio.wait(pending)
+        return {
+            url: None if task in pending
+            else task.result() if task.exception() is None else FETCH_FAILED
+            for url, task in tasks.items()
+        }
+
+    async def fetch_page(self, url: str) -> str:
+        """Fetch a webpage, escalating from HTTP to the browser if needed."""
+        content = await self.http_fetch(url)
+        if content is not None:
+            self.stats["http"] += 1
+            return content
+        return await self.crawl(url)
+
+    async def http_fetch(self, url: str) -> Optional[str]:
+        """Fetch a static page or pdf, None if it needs the browser.
+
+        The content type is checked before the body is read, and bodies
+        larger than ``HTTP_MAX_BYTES`` are abandoned while streaming.
+        """
+        try:
+            async with self._http.stream("GET", url) as response:
+                if response.status_code != 200:
+                    return None
+                content_type = response.headers.get("content-type", "")
+                content_type = content_type.split(";")[0].strip().lower()
+                if not (
+                    content_type in HTTP_CONTENT_TYPES or "html" in content_type
+                ):
+                    return None
+                if int(response.headers.get("content-length") or 0) > HTTP_MAX_BYTES:
+                    return None
+                chunks, size = [], 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > HTTP_MAX_BYTES:
+                        return None
+                    chunks.append(chunk)
+        except (httpx.HTTPError, ValueError):
+            return None
+
+        data = b"".join(chunks)
+        text = data.decode(response.charset_encoding or "utf-8", errors="replace")
+        try:
+            if content_type == "application/pdf" or data.startswith(b"%PDF"):
+                content = await asyncio.to_thread(pdf_to_markdown, data)
+            elif content_type in ("text/plain", "text/markdown"):
+                content = text.strip()
+            elif "html" in content_type:
+                if looks_js_rendered(text):
+                    return None
+                content = await asyncio.to_thread(
+                    html_to_markdown, text, str(response.url),
+                )
+            else:
+                return None
+        except Exception:   # pylint: disable=broad-except
+            logger.debug("Failed to convert %s.", url, exc_info=True)
+            return None
+        return content if len(content) >= HTTP_MIN_CHARS else None
+
+    async def crawl(self, url: str) -> str:
+        """Crawl a webpage with an idle browser. Must run on the pool loop."""
+        crawler = await self._idle.get()
+        try:
+            if crawler is None or not self._is_reusable(crawler):
+                crawler = await self._restart(crawler)
+            result = await crawler.arun(url, config=self.run_config)
+            self._pages[crawler] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:   # pylint: disable=broad-except
+            # Treat any crawler error as a crash, the browser is restarted lazily
+            logger.warning("Crawler crashed on %s.", url, exc_info=True)
+            await self._discard(crawler)
+            crawler = None
+            result = None
+        finally:
+            self._idle.put_nowait(crawler)
+
+        if result is not None and result.success and result.markdown.strip():
+            self.stats["browser"] += 1
+            return result.markdown.strip()
+        self.stats["failed"] += 1
+        return FETCH_FAILED
+
+    async def _fetch_limited(self, url: str) -> str:
+        """Fetch a webpage within the global and per-host limits."""
+        host = urlsplit(url).hostname or ""
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.max_per_host)
+        self._host_users[host] = self._host_users.get(host, 0) + 1
+        try:
+            async with self._global_limit, self._host_limits[host]:
+                return await self.fetch_page(url)
+        finally:
+            self._host_users[host] -= 1
+            if not self._host_users[host]:
+                del self._host_users[host], self._host_limits[host]
+
+    def close(self):
+        """Close all browsers and stop the pool loop."""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None or not thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(
+            self._when_ready(self._close_all()), loop,
+        ).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def _is_reusable(self, crawler: AsyncWebCrawler) -> bool:
+        """Health check and page recycling."""
+        if self._pages.get(crawler, 0) >= self.max_pages:
+            return False
+        browser_manager = getattr(crawler.crawler_strategy, "browser_manager", None)
+        browser = getattr(browser_manager, "browser", None)
+        return browser is None or browser.is_connected()
+
+    async def _warm_up(self):
+        """Start the HTTP client, and all browsers in the background.
+
+        Pages are fetched over HTTP right away, and escalations wait for
+        the first browser to start.
+        """
+        self._idle = asyncio.Queue()
+        self._http = httpx.AsyncClient(
+            headers=HTTP_HEADERS,
+            follow_redirects=True,
+            timeout=HTTP_FETCH_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=self.max_concurrency,
+            ),
+        )
+        self._global_limit = asyncio.Semaphore(self.max_concurrency)
+        self._host_limits = {}
+        self._host_users = {}
+        self._starting = asyncio.ensure_future(self._start_browsers())
+
+    async def _start_browsers(self):
+        """Start the browsers of the pool one by one."""
+        for _ in range(self.size):
+            try:
+                crawler = await self._start_crawler()
+            except Exception:   # pylint: disable=broad-except
+                logger.warning("Failed to start crawler.", exc_info=True)
+                crawler = None
+            self._idle.put_nowait(crawler)
+
+    async def _start_crawler(self) -> AsyncWebCrawler:
+        """Start a new browser."""
+        crawler = AsyncWebCrawler(config=self.browser_config)
+        # Track the browser before starting it, so that close reaches it
+        self._pages[crawler] = 0
+        try:
+            await crawler.start()
+        except BaseException:
+            await self._discard(crawler)
+            raise
+        return crawler
+
+    async def _restart(self, crawler: Optional[AsyncWebCrawler]) -> AsyncWebCrawler:
+        """Replace a recycled or broken browser by a new one."""
+        if crawler is not None:
+            await self._discard(crawler)
+        self.stats["restarts"] += 1
+        return await self._start_crawler()
+
+    async def _discard(self, crawler: Optional[AsyncWebCrawler]):
+        """Close a browser, ignoring errors of already dead browsers."""
+        if crawler is None:
+            return
+        self._pages.pop(crawler, None)
+        try:
+            await crawler.close()
+        except Exception:   # pylint: disable=broad-except
+            logger.debug("Failed to close crawler.", exc_info=True)
+
+    async def _close_all(self):
+        """Close the HTTP client and all browsers, idle or checked out."""
+        self._starting.cancel()
+        await asyncio.gather(self._starting, return_exceptions=True)
+        await self._http.aclose()
+        for crawler in list(self._pages):
+            await self._discard(crawler)
+        while not self._idle.empty():
+            self._idle.get_nowait()
+
+
+_POOL: Optional[CrawlerPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_crawler_pool() -> CrawlerPool:
+    """Get the process-wide crawler pool."""
+    global _POOL    # pylint: disable=global-statement
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = CrawlerPool()
+            atexit.register(_POOL.close)
+    return _POOL
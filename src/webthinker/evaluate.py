@@ -2,20 +2,33 @@
 
 import argparse
 import json
+import logging
 import os
 import re
 import string
+import threading
+import time
 from collections import Counter
-from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 from langchain_core.messages import SystemMessage
-from openai import APIError
+from openai import APIError, RateLimitError
 
-from webthinker.config import GROUP_KEYS, MAX_OUTPUT_RETRY
+from webthinker.cache import JudgmentCache, get_judgment_cache
+from webthinker.config import (GROUP_KEYS, JUDGE_BATCH_ROUNDS,
+                               JUDGE_MAX_BACKOFF, JUDGE_MAX_CONCURRENCY,
+                               JUDGE_MAX_RATE_LIMIT_RETRIES, MAX_OUTPUT_RETRY,
+                               PERFORMANCE_FLUSH_INTERVAL)
 from webthinker.model import get_evaluation_model
 from webthinker.prompts import EVALUATE_PROMPT
 from webthinker.schema import EvaluationOutput
 
+logger = logging.getLogger("webthinker.evaluate")
+
+# Metrics of score_qa, llm_score is added by LLM evaluation
+QA_METRICS = ["exact_match", "accuracy", "f1"]
+
 
 def identify_group(
     task: Dict[str, str],
@@ -30,20 +43,47 @@ def identify_group(
     return default
 
 
+def load_results(path: str) -> List[Dict[str, str]]:
+    """Load results from a json or jsonl file.
+
+    In jsonl files the last record of a task wins, and lines torn by a
+    crash are skipped. A missing file has no results yet.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        if not path.endswith(".jsonl"):
+            return json.load(f)
+        results = {}
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[result["id"]] = result
+    return list(results.values())
+
+
 ###################
 # Evaluate QA tasks
 ###################
+ARTICLE_PATTERN = re.compile(r"\b(a|an|the)\b")
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+
 def normalize_qa_answer(answer: str) -> str:
-    """Normalize the answer for QA tasks."""
+    """Normalize the answer for QA tasks.
+
+    Answers are compared character by character: articles, punctuation
+    and spaces are removed, and the remaining characters are separated by
+    single spaces.
+    """
     # Remove article (a, an, the)
-    answer = re.sub(r"\b(a|an|the)\b", " ", answer)
-    # Remove punctuation
-    answer = " ".join(c for c in answer if c not in string.punctuation)
-    # Remove extra spaces
-    answer = " ".join(answer.strip().split())
-    # Lowercase
-    answer = answer.lower()
-    return answer
+    answer = ARTICLE_PATTERN.sub(" ", answer)
+    # Remove punctuation and spaces
+    answer = "".join(answer.translate(PUNCTUATION_TABLE).split())
+    # Separate characters and lowercase
+    return " ".join(answer).lower()
 
 
 def token_f1(label: str, pred: str) -> float:
@@ -62,195 +102,357 @@ def token_f1(label: str, pred: str) -> float:
 def evaluate_qa(
     results: List[Dict[str, str]],
     llm_eval: bool = False,
+    max_concurrency: int = JUDGE_MAX_CONCURRENCY,
 ) -> Dict[str, float]:
-    """Evaluate."""
-    # Prepare lists
-    questions = [
-        result["question"]
-        for result in sorted(results, key=lambda x: x["id"])
-    ]
-    norm_label = [
-        normalize_qa_answer(result["label"])
-        for result in sorted(results, key=lambda x: x["id"])
-    ]
-    label = [
-        result["label"]
-        for result in sorted(results, key=lambda x: x["id"])
-    ]
-    norm_pred = [
-        normalize_qa_answer(result["pred"])
-        for result in sorted(results, key=lambda x: x["id"])
-    ]
-    pred = [
-        result["pred"]
-        for result in sorted(results, key=lambda x: x["id"])
-    ]
-    group = [
-        result["group"]
-        for result in sorted(results, key=lambda x: x["id"])
-    ]
-
-    # Handle basic evaluation
-    results = {
-        "exact_match": exact_match(norm_label, norm_pred, group),
-        "accuracy": accuracy(norm_label, norm_pred, group),
-        "f1": f1_score(norm_label, norm_pred, group),
-    }
+    """Evaluate all metrics and groups in a single pass over the results."""
+    results = sorted(results, key=lambda x: x["id"])
+    # Report every metric, even without any result
+    metrics = QA_METRICS + ["llm_score"] if llm_eval else QA_METRICS
+    sums = {metric: {} for metric in metrics}
+    for result in results:
+        for metric, score in score_qa(result["label"], result["pred"]).items():
+            accumulate(sums, metric, result["group"], score)
 
     # Handle llm evaluation
     if llm_eval:
-        results["llm_score"] = llm_score(questions, label, pred, group)
-
-    return results
-
-
-def exact_match(
-    label: List[str],
-    pred: List[str],
-    group: List[str] = None,
-):
-    """Calculate exact match."""
-    # Overall
-    scores = [
-        1 if l == p else 0 for l, p in zip(label, pred)
-    ]
-
-    # Group
-    group_scores = {}
-    for g, s in zip(group, scores):
-        group_scores.setdefault(g, []).append(s)
-
+        judgments = judge_answers(
+            [result["question"] for result in results],
+            [result["label"] for result in results],
+            [result["pred"] for result in results],
+            max_concurrency,
+        )
+        for result, judgment in zip(results, judgments):
+            score = 1 if judgment == "Correct" else 0
+            accumulate(sums, "llm_score", result["group"], score)
+
+    return summarize(sums)
+
+
+def score_qa(label: str, pred: str) -> Dict[str, float]:
+    """Score a single prediction with the basic metrics."""
+    norm_label = normalize_qa_answer(label)
+    norm_pred = normalize_qa_answer(pred)
     return {
-        "overall": sum(scores) / len(scores) if scores else 0,
-        "group": {
-            g: sum(s) / len(s) if s else 0
-            for g, s in group_scores.items()
-        }
+        "exact_match": 1 if norm_label == norm_pred else 0,
+        "accuracy": 1 if norm_label in norm_pred else 0,
+        "f1": token_f1(norm_label, norm_pred),
     }
 
 
-def accuracy(
-    label: List[str],
-    pred: List[str],
-    group: List[str] = None,
+def accumulate(
+    sums: Dict[str, Dict[Optional[str], List[float]]],
+    metric: str,
+    group: str,
+    score: float,
+    weight: int = 1,
 ):
-    """Calculate accuracy."""
-    # Overall
-    scores = [
-        1 if l in p else 0 for l, p in zip(label, pred)
-    ]
-
-    # Group
-    group_scores = {}
-    for g, s in zip(group, scores):
-        group_scores.setdefault(g, []).append(s)
-
-    return {
-        "overall": sum(scores) / len(scores) if scores else 0,
-        "group": {
-            g: sum(s) / len(s) if s else 0
-            for g, s in group_scores.items()
-        }
-    }
+    """Add a weighted score to the overall and group sums of a metric."""
+    metric_sums = sums.setdefault(metric, {})
+    for key in (None, group):
+        key_sums = metric_sums.setdefault(key, [0., 0])
+        key_sums[0] += weight * score
+        key_sums[1] += weight
 
 
-def f1_score(
-    label: List[str],
-    pred: List[str],
-    group: List[str] = None,
-):
-    """Calculate F1 score."""
-    # Overall
-    scores = [
-        token_f1(l, p) for l, p in zip(label, pred)
-    ]
-
-    # Group
-    group_scores = {}
-    for g, s in zip(group, scores):
-        group_scores.setdefault(g, []).append(s)
+def summarize(
+    sums: Dict[str, Dict[Optional[str], List[float]]],
+) -> Dict[str, Dict]:
+    """Turn overall and group sums into mean scores."""
+    def mean(key_sums: Optional[List[float]]) -> float:
+        return key_sums[0] / key_sums[1] if key_sums and key_sums[1] else 0
 
     return {
-        "overall": sum(scores) / len(scores) if scores else 0,
-        "group": {
-            g: sum(s) / len(s) if s else 0
-            for g, s in group_scores.items()
+        metric: {
+            "overall": mean(metric_sums.get(None)),
+            "group": {
+                g: mean(s) for g, s in metric_sums.items() if g is not None
+            },
         }
+        for metric, metric_sums in sums.items()
     }
 
 
-def llm_score(
+def judge_answers(
     questions: List[str],
     label: List[str],
     pred: List[str],
-    group: List[str] = None,
-):
-    """Calculate LLM equivalence score."""
-    # Overall
-    model = get_evaluation_model().with_structured_output(
-        EvaluationOutput,
-    ).with_retry(
-        stop_after_attempt=MAX_OUTPUT_RETRY,
-    )
-    scores = []
-    for q, l, p in zip(questions, label, pred):
-        try:
-            content = EVALUATE_PROMPT.format(
-                research_question=q,
-                labeled_answer=l,
-                predicted_answer=p,
-            )
-            response = model.invoke(
-                [SystemMessage(content=content)],
-            )
-            result = response["justification"]
-        except (APIError, TypeError):
-            result = "Incorrect"
-
-        if result == "Correct":
-            scores.append(1)
+    max_concurrency: int = JUDGE_MAX_CONCURRENCY,
+) -> List[str]:
+    """Judge predictions concurrently, in the order of the inputs.
+
+    Predictions are judged in batches of a few rounds of the current
+    concurrency. Rate limited judgments are retried after a backoff with
+    halved concurrency, which grows back by one after each clean batch.
+    Other failures are retried up to MAX_OUTPUT_RETRY attempts. Judgments
+    are read through the judgment cache, so only new predictions are sent.
+    Predictions still rate limited after JUDGE_MAX_RATE_LIMIT_RETRIES
+    retries are judged incorrect, without caching the judgment.
+    """
+    # Retry by hand, as RunnableRetry.batch misplaces retried outputs
+    chat_model = get_evaluation_model()
+    model = chat_model.with_structured_output(EvaluationOutput)
+    inputs = [
+        [SystemMessage(content=EVALUATE_PROMPT.format(
+            research_question=q,
+            labeled_answer=l,
+            predicted_answer=p,
+        ))]
+        for q, l, p in zip(questions, label, pred)
+    ]
+    judgments = ["Incorrect"] * len(inputs)
+    attempts = [0] * len(inputs)
+    rate_limits = [0] * len(inputs)
+
+    # Only judge predictions missing from the judgment cache
+    judgment_cache = get_judgment_cache()
+    # Identify the model config as langchain LLM caches do
+    llm_string = chat_model._get_llm_string()   # pylint: disable=protected-access
+    model_config = f"{chat_model.name}:{llm_string}"
+    keys = [
+        JudgmentCache.make_key(messages[0].content, model_config)
+        for messages in inputs
+    ]
+    cached = judgment_cache.get_many(keys)
+    pending = []
+    for i, key in enumerate(keys):
+        if key in cached:
+            judgments[i] = cached[key]
         else:
-            scores.append(0)
-
-    # Overall
-    group_scores = {}
-    for g, s in zip(group, scores):
-        group_scores.setdefault(g, []).append(s)
-
-    return {
-        "overall": sum(scores) / len(scores) if scores else 0,
-        "group": {
-            g: sum(s) / len(s) if s else 0
-            for g, s in group_scores.items()
+            pending.append(i)
+    concurrency = max_concurrency
+    backoff = 1
+    while pending:
+        batch = pending[:concurrency * JUDGE_BATCH_ROUNDS]
+        pending = pending[len(batch):]
+        responses = model.batch(
+            [inputs[i] for i in batch],
+            config={"max_concurrency": concurrency},
+            return_exceptions=True,
+        )
+        rate_limited, failed, new_judgments = [], [], {}
+        for i, response in zip(batch, responses):
+            if isinstance(response, RateLimitError):
+                rate_limits[i] += 1
+                if rate_limits[i] <= JUDGE_MAX_RATE_LIMIT_RETRIES:
+                    rate_limited.append(i)
+                else:
+                    logger.warning("Gave up judging a rate limited prediction.")
+            elif isinstance(response, Exception):
+                attempts[i] += 1
+                if attempts[i] < MAX_OUTPUT_RETRY:
+                    failed.append(i)
+                elif not isinstance(response, (APIError, TypeError)):
+                    raise response
+            elif response is not None:
+                judgments[i] = response["justification"]
+                new_judgments[keys[i]] = judgments[i]
+        judgment_cache.put_many(new_judgments)
+        pending = rate_limited + failed + pending
+
+        # Adapt concurrency to the rate limit
+        if rate_limited:
+            concurrency = max(concurrency // 2, 1)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, JUDGE_MAX_BACKOFF)
+        else:
+            concurrency = min(concurrency + 1, max_concurrency)
+            backoff = 1
+    return judgments
+
+
+#####################
+# Streaming evaluation
+#####################
+class StreamingEvaluator:
+    """Evaluate QA results as soon as their tasks complete.
+
+    Per-group metrics are kept as running sums and counts. LLM judgments
+    run in a background thread, so that judging overlaps with the agent.
+    Results waiting for a judgment are judged together in one batch, so
+    that they share the concurrency and the rate limit backoff.
+    The performance is flushed to ``path`` every ``flush_interval``
+    seconds. A result added again for the same task, e.g. a retry of a
+    failed task, replaces the previous one.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        llm_eval: bool = False,
+        max_concurrency: int = JUDGE_MAX_CONCURRENCY,
+        flush_interval: float = PERFORMANCE_FLUSH_INTERVAL,
+    ):
+        self.path = path
+        self.llm_eval = llm_eval
+        self.max_concurrency = max_concurrency
+        self.flush_interval = flush_interval
+        self.metrics = list(QA_METRICS)
+        if llm_eval:
+            self.metrics.append("llm_score")
+        # Sums and counts by metric and group, None for overall
+        self._sums: Dict[str, Dict[Optional[str], List[float]]] = {
+            metric: {} for metric in self.metrics
         }
-    }
+        self._scores: Dict[int, Dict[str, float]] = {}
+        self._groups: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        # Results waiting for a judgment, with the scores they belong to
+        self._pending: List[Tuple[Dict[str, str], Dict[str, float]]] = []
+        self._draining = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def add(self, result: Dict[str, str]):
+        """Score a result and schedule its judgment."""
+        scores = score_qa(result["label"], result["pred"])
+        with self._lock:
+            self._remove(result["id"])
+            self._scores[result["id"]] = {}
+            self._groups[result["id"]] = result["group"]
+            for metric, score in scores.items():
+                self._update(result["id"], metric, score)
+            if self.llm_eval:
+                self._pending.append((result, self._scores[result["id"]]))
+                if not self._draining:
+                    self._draining = True
+                    self._executor.submit(self._drain)
+        self._maybe_flush()
+
+    def performance(self) -> Dict[str, Dict]:
+        """Get the current performance, in the format of evaluate_qa."""
+        with self._lock:
+            return summarize(self._sums)
+
+    def flush(self):
+        """Write the current performance to path atomically."""
+        self._last_flush = time.monotonic()
+        if self.path is None:
+            return
+        with self._flush_lock:
+            performance = self.performance()
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(performance, f, indent=4, ensure_ascii=False)
+            os.replace(self.path + ".tmp", self.path)
+
+    def finish(self) -> Dict[str, Dict]:
+        """Wait for pending judgments, flush and return the performance."""
+        self._executor.shutdown(wait=True)
+        self.flush()
+        return self.performance()
+
+    def _drain(self):
+        """Judge the pending results in batches until none is left."""
+        while True:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                if not batch:
+                    self._draining = False
+                    return
+            try:
+                judgments = judge_answers(
+                    [result["question"] for result, _ in batch],
+                    [result["label"] for result, _ in batch],
+                    [result["pred"] for result, _ in batch],
+                    max_concurrency=self.max_concurrency,
+                )
+            except Exception:   # pylint: disable=broad-except
+                logger.warning("Failed to judge %d tasks.", len(batch), exc_info=True)
+                judgments = ["Incorrect"] * len(batch)
+            with self._lock:
+                for (result, scores), judgment in zip(batch, judgments):
+                    # Skip results replaced while being judged
+                    if self._scores.get(result["id"]) is scores:
+                        self._update(
+                            result["id"], "llm_score", 1 if judgment == "Correct" else 0,
+                        )
+            self._maybe_flush()
+
+    def _update(self, task_id: int, metric: str, score: float):
+        """Add a score to the running sums. Must hold the lock."""
+        self._scores[task_id][metric] = score
+        accumulate(self._sums, metric, self._groups[task_id], score)
+
+    def _remove(self, task_id: int):
+        """Remove the scores of a replaced result. Must hold the lock."""
+        for metric, score in self._scores.pop(task_id, {}).items():
+            accumulate(self._sums, metric, self._groups[task_id], score, weight=-1)
+
+    def _maybe_flush(self):
+        """Flush if the flush interval has elapsed."""
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+
+def evaluate_file(
+    path: str,
+    llm_eval: bool = False,
+    max_concurrency: int = JUDGE_MAX_CONCURRENCY,
+) -> Dict[str, Dict]:
+    """Evaluate a result file and save performance.json next to it."""
+    results = load_results(path)
+    start = time.perf_counter()
+    performance = evaluate_qa(
+        results,
+        llm_eval=llm_eval,
+        max_concurrency=max_concurrency,
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"Evaluated {len(results)} results of {path} in {elapsed:.1f}s, "
+        f"{len(results) / max(elapsed, 1e-9):.2f} results/s."
+    )
+    output_path = os.path.join(os.path.dirname(path), "performance.json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(performance, f, ensure_ascii=False, indent=4)
+    return performance
 
 
 def main():
-    """Directly evaluate the result."""
-    # Get path
+    """Directly evaluate the results."""
+    # Get paths
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--path",
         type=str,
+        nargs="+",
     )
     parser.add_argument(
         "--llm_eval",
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=JUDGE_MAX_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+    )
     args = parser.parse_args()
 
-    # Read file
-    with open(args.path, "r", encoding="utf-8") as f:
-        results = json.load(f)
-
-    # Evaluate
-    performance = evaluate_qa(results, llm_eval=args.llm_eval)
-    print("Performance:", performance)
-    output_path = os.path.join(os.path.dirname(args.path), "performance.json")
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(performance, f, ensure_ascii=False, indent=4)
+    # Evaluate, one process per result file
+    in_process = len(args.path) == 1 or args.workers <= 1
+    if in_process:
+        performances = [
+            evaluate_file(path, args.llm_eval, args.max_concurrency)
+            for path in args.path
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=min(args.workers, len(args.path))) as executor:
+            performances = list(executor.map(
+                evaluate_file,
+                args.path,
+                [args.llm_eval] * len(args.path),
+                [args.max_concurrency] * len(args.path),
+            ))
+    for path, performance in zip(args.path, performances):
+        print(f"Performance of {path}:", performance)
+    if args.llm_eval and in_process:
+        print("Judgment cache:", get_judgment_cache().stats)
 
 
 if __name__ == "__main__":
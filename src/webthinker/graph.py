@@ -1,9 +1,11 @@
 """State graph for solution mode."""
 
-from typing import Annotated, Literal
+import asyncio
+from typing import Annotated, Literal, Optional
 
 from langchain_core.messages import SystemMessage, ToolMessage
 from langchain_core.tools import InjectedToolArg, InjectedToolCallId, tool
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import END, START, StateGraph
 from langgraph.prebuilt import InjectedState, ToolNode
 from langgraph.types import Command
@@ -12,17 +14,19 @@ from webthinker.config import (MAX_INTERACTIONS, MAX_OUTPUT_RETRY,
                                MAX_SEARCH_LIMIT, SEARCH_TOOL, SEARCH_TOP_K)
 from webthinker.model import get_supervisor_model, get_writer_model
 from webthinker.prompts import (EXTRACT_INFORMATION_PROMPT,
-                                SEARCH_INTENT_PROMPT,
+                                NEXT_TOOL_CALL_PROMPT, SEARCH_INTENT_PROMPT,
                                 SUMMARIZE_SOLUTION_PROMPT, SUPERVISOR_PROMPT)
 from webthinker.schema import (WebThinkerSolutionInputState,
                                WebThinkerSolutionOutputState,
                                WebThinkerSolutionState)
-from webthinker.utils import (extract_context_by_snippet, fetch_content,
-                              format_search_results, get_buffer_string,
-                              get_logger, search_google_serper, search_tavily)
+from webthinker.utils import (afetch_handles, aload_contents, compact_history,
+                              extract_context_by_snippet,
+                              format_search_results, get_logger,
+                              history_prompt, search_google_serper,
+                              search_tavily)
 
 
-def webthinker():
+def webthinker(checkpointer: Optional[BaseCheckpointSaver] = None):
     """WebThinker solution mode."""
     # Init state graph
     builder = StateGraph(
@@ -55,10 +59,10 @@ def webthinker():
     # builder.add_edge("supervisor", "supervisor_tool")
     # builder.add_edge("supervisor", "summarize_solution")
     builder.add_edge("summarize_solution", END)
-    return builder.compile()
+    return builder.compile(checkpointer=checkpointer)
 
 
-def supervisor(
+async def supervisor(
     state: WebThinkerSolutionState,
     prompt: Annotated[str, InjectedToolArg] = SUPERVISOR_PROMPT,
 ) -> Command[Literal["supervisor_tool", "__end__"]]:
@@ -84,14 +88,24 @@ def supervisor(
         )
         history.append(SystemMessage(init_prompt))
     else:
-        history.append(SystemMessage("Please generate next tool call."))
+        history.append(SystemMessage(NEXT_TOOL_CALL_PROMPT))
 
     # Call tools
     tools = [search_query, research_complete]
     model_with_tool = model.bind_tools(tools).with_retry(
         stop_after_attempt=MAX_OUTPUT_RETRY,
     )
-    response = model_with_tool.invoke(history)
+    messages, num_tokens, num_compacted_tokens = compact_history(
+        history,
+        nudge=NEXT_TOOL_CALL_PROMPT,
+    )
+    logger.info(
+        "History compacted from %d to %d tokens, %d tokens saved.",
+        num_tokens,
+        num_compacted_tokens,
+        num_tokens - num_compacted_tokens,
+    )
+    response = await model_with_tool.ainvoke(messages)
 
     # Log output
     logger.info(
@@ -115,7 +129,7 @@ def supervisor(
     )
 
 
-def summarize_solution(
+async def summarize_solution(
     state: WebThinkerSolutionState,
     prompt: Annotated[str, InjectedToolArg] = SUMMARIZE_SOLUTION_PROMPT,
 ) -> Command[Literal["__end__"]]:
@@ -126,12 +140,8 @@ def summarize_solution(
     logger = get_logger("webthinker.summarize_solution", state.get("log_file", None))
     logger.info("=== Summarize Solution ===")
 
-    previous_thoughts = get_buffer_string(history)
-    content = prompt.format(
-        research_question=research_question,
-        previous_thoughts=previous_thoughts,
-    )
-    response = model.invoke([SystemMessage(content)])
+    content = prompt.format(research_question=research_question)
+    response = await model.ainvoke(history_prompt(history, content))
     solution = response.content
 
     logger.info(
@@ -149,7 +159,7 @@ def summarize_solution(
 # Research Complete tool
 ########################
 @tool
-def research_complete(
+async def research_complete(
     final_answer: Annotated[str, ..., "the final answer"],
     state: Annotated[dict, InjectedState],
     tool_call_id: Annotated[str, InjectedToolCallId],
@@ -174,7 +184,7 @@ def research_complete(
 # Search query tool
 ###################
 @tool
-def search_query(
+async def search_query(
     query: Annotated[str, ..., "the query to search on the web."],
     state: Annotated[dict, InjectedState],
     tool_call_id: Annotated[str, InjectedToolCallId],
@@ -182,7 +192,6 @@ def search_query(
     extract_information_prompt: Annotated[str, InjectedToolArg] = EXTRACT_INFORMATION_PROMPT,
 ) -> str:
     """Search query tool."""
-    total_interactions = state.get("total_interactions", 0)
     history = state.get("history", [])
     url_cache = state.get("url_cache", {})
     executed_search_queries = state.get("executed_search_queries", set())
@@ -194,62 +203,68 @@ def search_query(
     if query in executed_search_queries:
         logger.info("Query has been executed before.")
         return Command(update={
-            "total_interactions": total_interactions + 1,
+            "total_interactions": 1,
             "history": [ToolMessage(
                 "You have already searched for this query.",
                 tool_call_id=tool_call_id,
             )],
         })
 
-    # Generate search intent
-    previous_thoughts = get_buffer_string(history)
+    async def search_and_fetch():
+        # Execute search
+        if SEARCH_TOOL == "tavily":
+            search = search_tavily
+        elif SEARCH_TOOL == "google":
+            search = search_google_serper
+        else:
+            logger.warning(
+                "Unknown search tool: %s, default to use google.",
+                SEARCH_TOOL,
+            )
+            search = search_google_serper
+        results = await search(query=query, max_results=SEARCH_TOP_K)
+        logger.info(
+            "Totally %d results found:\n"
+            "%s\n",
+            len(results),
+            "\n".join(r["url"] for r in results),
+        )
+
+        # Fetch webpages, state only keeps their content digests
+        url_to_fetch = [result["url"] for result in results if result["url"] not in url_cache]
+        return results, await afetch_handles(url_to_fetch)
+
+    # Generate search intent, which does not block search and fetch
     content = intent_prompt.format(
         # research_question=research_question,
-        previous_thoughts=previous_thoughts,
     )
-    response = model.invoke([SystemMessage(content)])
-    search_intent = response.content
+    intent_response, (results, new_handles) = await asyncio.gather(
+        model.ainvoke(history_prompt(history, content)),
+        search_and_fetch(),
+    )
+    search_intent = intent_response.content
     logger.info(
         "Search intent:\n"
         "%s\n",
         search_intent,
     )
 
-    # Execute search
-    if SEARCH_TOOL == "tavily":
-        results = search_tavily(query=query, max_results=SEARCH_TOP_K)
-    elif SEARCH_TOOL == "google":
-        results = search_google_serper(query=query, max_results=SEARCH_TOP_K)
-    else:
-        logger.warning(
-            "Unknown search tool: %s, default to use google.",
-            SEARCH_TOOL,
-        )
-        results = search_google_serper(query=query, max_results=SEARCH_TOP_K)
-    logger.info(
-        "Totally %d results found:\n"
-        "%s\n",
-        len(results),
-        "\n".join(r["url"] for r in results),
-    )
-
-    # Fetch webpages
-    url_to_fetch = [result["url"] for result in results if result["url"] not in url_cache]
-    for url in url_to_fetch:
-        content = fetch_content(url)
-        url_cache[url] = content
-
     # Truncate contents
+    handles = {**url_cache, **new_handles}
+    contents = await aload_contents({
+        result["url"]: handles[result["url"]] for result in results
+    })
     for i, result in enumerate(results):
-        raw_content = url_cache[result["url"]]
+        raw_content = contents[result["url"]]
         # Retain more chars for higher rank documents
         if i < 5:
             context_chars = 4000
         else:
             context_chars = 2000
-        # Extract original contents according to snippet
+        # Extract original contents according to snippet, off the event loop
         if raw_content != "Can not fetch the page content.":
-            context = extract_context_by_snippet(
+            context = await asyncio.to_thread(
+                extract_context_by_snippet,
                 raw_content=raw_content,
                 snippet=result["snippet"],
                 context_chars=context_chars,
@@ -265,19 +280,18 @@ def search_query(
         search_intent=search_intent,
         search_results=formatted_results,
     )
-    response = model.invoke([SystemMessage(content)])
+    response = await model.ainvoke([SystemMessage(content)])
     final_information = response.content
-    executed_search_queries.add(query)
     logger.info(
         "Relevant information extracted:\n"
         "%s\n",
         final_information
     )
 
-    # Update state
+    # Update state, parallel calls are merged by the reducers
     return Command(update={
-        "url_cache": url_cache,
-        "executed_search_queries": executed_search_queries,
-        "total_interactions": total_interactions + 1,
+        "url_cache": new_handles,
+        "executed_search_queries": {query},
+        "total_interactions": 1,
         "history": [ToolMessage(final_information, tool_call_id=tool_call_id)],
     })
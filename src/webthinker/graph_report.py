@@ -1,9 +1,12 @@
 """State graph for report mode."""
 
-from typing import Annotated, Literal
+import asyncio
+import uuid
+from typing import Annotated, Literal, Optional
 
 from langchain_core.messages import SystemMessage, ToolMessage
 from langchain_core.tools import InjectedToolArg, InjectedToolCallId, tool
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import END, START, StateGraph
 from langgraph.prebuilt import InjectedState, ToolNode
 from langgraph.types import Command
@@ -16,21 +19,23 @@ from webthinker.prompts_report import (EDIT_ARTICLE_PROMPT,
                                        EXTRACT_INFORMATION_PROMPT,
                                        FINAL_REFINEMENT_PROMPT,
                                        GENERATE_PLAN_PROMPT,
+                                       NEXT_TOOL_CALL_PROMPT,
                                        SEARCH_INTENT_PROMPT, SUPERVISOR_PROMPT,
                                        TITLE_PROMPT, WRITE_SECTION_PROMPT)
 from webthinker.schema import (WebThinkerReportInputState,
                                WebThinkerReportOutputState,
                                WebThinkerReportState)
-from webthinker.utils import (BM25Retriever, extract_context_by_snippet,
-                              extract_outline, fetch_content,
-                              format_search_results, get_buffer_string,
-                              get_logger, search_google_serper, search_tavily)
+from webthinker.utils import (afetch_handles, aload_contents, compact_history,
+                              extract_context_by_snippet, format_outline,
+                              format_search_results, get_logger, get_retriever,
+                              history_prompt, index_headers,
+                              search_google_serper, search_tavily)
 
 
 ############
 # WebThinker
 ############
-def webthinker_report():
+def webthinker_report(checkpointer: Optional[BaseCheckpointSaver] = None):
     """WebThinker report mode."""
     # Init state graph
     builder = StateGraph(
@@ -70,10 +75,10 @@ def webthinker_report():
     # builder.add_edge("supervisor", "supervisor_tool")
     # builder.add_edge("supervisor", "final_refinement")
     builder.add_edge("final_refinement", END)
-    return builder.compile()
+    return builder.compile(checkpointer=checkpointer)
 
 
-def generate_plan(
+async def generate_plan(
     state: WebThinkerReportState,
     prompt: str = GENERATE_PLAN_PROMPT,
 ) -> Command[Literal["supervisor"]]:
@@ -85,7 +90,7 @@ def generate_plan(
 
     # Get research plan
     content = prompt.format(research_question=research_question)
-    response = model.invoke([SystemMessage(content)])
+    response = await model.ainvoke([SystemMessage(content)])
     plan = response.content
 
     # Log output
@@ -97,10 +102,11 @@ def generate_plan(
 
     return {
         "plan": plan,
+        "run_id": uuid.uuid4().hex,
     }
 
 
-def supervisor(
+async def supervisor(
     state: WebThinkerReportState,
     prompt: str = SUPERVISOR_PROMPT,
 ) -> Command[Literal["supervisor_tool", "final_refinement"]]:
@@ -126,14 +132,24 @@ def supervisor(
         )
         history.append(SystemMessage(init_prompt))
     else:
-        history.append(SystemMessage("Please generate next tool call."))
+        history.append(SystemMessage(NEXT_TOOL_CALL_PROMPT))
 
     # Call tools
     tools = [search_query, write_section, check_article, edit_article, research_complete]
     model_with_tool = model.bind_tools(tools).with_retry(
         stop_after_attempt=MAX_OUTPUT_RETRY,
     )
-    response = model_with_tool.invoke(history)
+    messages, num_tokens, num_compacted_tokens = compact_history(
+        history,
+        nudge=NEXT_TOOL_CALL_PROMPT,
+    )
+    logger.info(
+        "History compacted from %d to %d tokens, %d tokens saved.",
+        num_tokens,
+        num_compacted_tokens,
+        num_tokens - num_compacted_tokens,
+    )
+    response = await model_with_tool.ainvoke(messages)
 
     # Log output
     logger.info(
@@ -157,7 +173,7 @@ def supervisor(
     )
 
 
-def final_refinement(
+async def final_refinement(
     state: WebThinkerReportState,
     prompt: str = FINAL_REFINEMENT_PROMPT,
 ) -> Command[Literal["__end__"]]:
@@ -173,7 +189,7 @@ def final_refinement(
         research_question=research_question,
         article=article,
     )
-    response = model.invoke([SystemMessage(content)])
+    response = await model.ainvoke([SystemMessage(content)])
     final_report = response.content
 
     # Log output
@@ -192,7 +208,7 @@ def final_refinement(
 # Research Complete tool
 ########################
 @tool
-def research_complete(
+async def research_complete(
     state: Annotated[dict, InjectedState],
     tool_call_id: Annotated[str, InjectedToolCallId],
 ) -> str:
@@ -211,7 +227,7 @@ def research_complete(
 # Write section tool
 ####################
 @tool
-def write_section(
+async def write_section(
     section_title: Annotated[str, ..., "the section title."],
     section_goal: Annotated[str, ..., "the goal of the section."],
     state: Annotated[dict, InjectedState],
@@ -220,11 +236,10 @@ def write_section(
 ) -> str:
     """Write section tool."""
     research_question = state.get("research_question", "")
-    total_interactions = state.get("total_interactions", 0)
-    article_outline = state.get("article_outline", "")
+    article_headers = state.get("article_headers", [])
     history = state.get("history", [])
     article = state.get("article", "")
-    retriever = state.get("retriever", BM25Retriever())
+    retriever = get_retriever(state.get("run_id", None), state.get("documents", []))
     model = get_writer_model()
     logger = get_logger("webthinker.write_section", state.get("log_file", None))
     logger.info("=== Write Section ===")
@@ -238,27 +253,25 @@ def write_section(
     ])
 
     # Generate section content
-    previous_thoughts = get_buffer_string(history)
     content = prompt.format(
         relevant_documents=formatted_documents,
         research_question=research_question,
-        previous_thoughts=previous_thoughts,
-        article_outline=article_outline,
+        article_outline=format_outline(article_headers),
         section_title=section_title,
         section_goal=section_goal,
     )
-    response = model.invoke([SystemMessage(content)])
+    response = await model.ainvoke(history_prompt(history, content))
     section_content = response.content
 
-    # Write section
+    # Write section, only the new section is parsed for headers
     article += section_content
-    article_outline = extract_outline(article)
+    article_headers = index_headers(article, article_headers)
 
     # Update state
     return Command(update={
         "article": article,
-        "article_outline": article_outline,
-        "total_interactions": total_interactions + 1,
+        "article_headers": article_headers,
+        "total_interactions": 1,
         "history": [ToolMessage("Section written.", tool_call_id=tool_call_id)]
     })
 
@@ -267,36 +280,36 @@ def write_section(
 # Check article tool
 ####################
 @tool
-def check_article(
+async def check_article(
     state: Annotated[dict, InjectedState],
     tool_call_id: Annotated[str, InjectedToolCallId],
     prompt: Annotated[str, InjectedToolArg] = TITLE_PROMPT,
 ) -> str:
     """Check article tool."""
     research_question = state.get("research_question", "")
-    total_interactions = state.get("total_interactions", 0)
     article = state.get("article", "")
+    article_headers = state.get("article_headers", [])
     model = get_writer_model()
     logger = get_logger("webthinker.check_article", state.get("log_file", None))
     logger.info("=== Check Article ===")
 
     # Check title
+    title_headers = []
     if not article.startswith("# "):
         content = prompt.format(
             research_question=research_question,
             article=article,
         )
-        response = model.invoke([SystemMessage(content)])
+        response = await model.ainvoke([SystemMessage(content)])
         title = response.content
-        article = f"# {title}\n" + article
+        title_headers = index_headers(f"# {title}\n")
 
-    # Extract outline
-    article_outline = extract_outline(article)
+    # Format outline from the indexed headers
+    article_outline = format_outline(title_headers + article_headers)
 
     # Update state
     return Command(update={
-        "article_outline": article_outline,
-        "total_interactions": total_interactions + 1,
+        "total_interactions": 1,
         "history": [ToolMessage(article_outline, tool_call_id=tool_call_id)],
     })
 
@@ -305,7 +318,7 @@ def check_article(
 # Edit article tool
 ####################
 @tool
-def edit_article(
+async def edit_article(
     instruction: Annotated[str, ..., "the instruction for editing the article."],
     state: Annotated[dict, InjectedState],
     tool_call_id: Annotated[str, InjectedToolCallId],
@@ -313,7 +326,6 @@ def edit_article(
 ) -> str:
     """Edit article tool."""
     article = state.get("article", "")
-    total_interactions = state.get("total_interactions", 0)
     model = get_writer_model()
     logger = get_logger("webthinker.edit_article", state.get("log_file", None))
     logger.info("=== Edit Article ===")
@@ -323,13 +335,14 @@ def edit_article(
         instruction=instruction,
         article=article,
     )
-    response = model.invoke([SystemMessage(content)])
+    response = await model.ainvoke([SystemMessage(content)])
     edited_article = response.content
 
-    # Update state
+    # Update state, the edited article is indexed from scratch
     return Command(update={
         "article": edited_article,
-        "total_interactions": total_interactions + 1,
+        "article_headers": index_headers(edited_article),
+        "total_interactions": 1,
         "history": [ToolMessage("edit done", tool_call_id=tool_call_id)],
     })
 
@@ -338,7 +351,7 @@ def edit_article(
 # Search query tool
 ###################
 @tool
-def search_query(
+async def search_query(
     query: Annotated[str, ..., "the query to search on the web."],
     state: Annotated[dict, InjectedState],
     tool_call_id: Annotated[str, InjectedToolCallId],
@@ -347,48 +360,50 @@ def search_query(
 ) -> str:
     """Search query tool."""
     research_question = state.get("research_question", "")
-    total_interactions = state.get("total_interactions", 0)
     history = state.get("history", [])
     url_cache = state.get("url_cache", {})
-    retriever = state.get("retriever", BM25Retriever())
     model = get_writer_model()
     logger = get_logger("webthinker.search_query", state.get("log_file", None))
     logger.info("=== Search Query ===")
 
-    # Generate search intent
-    previous_thoughts = get_buffer_string(history)
-    content = intent_prompt.format(
-        research_question=research_question,
-        previous_thoughts=previous_thoughts,
+    async def search_and_fetch():
+        # Execute search
+        if SEARCH_TOOL == "tavily":
+            search = search_tavily
+        elif SEARCH_TOOL == "google":
+            search = search_google_serper
+        else:
+            raise ValueError(f"Unknown search tool: {SEARCH_TOOL}")
+        results = await search(query=query, max_results=SEARCH_TOP_K)
+
+        # Fetch webpages, state only keeps their content digests
+        url_to_fetch = [result["url"] for result in results if result["url"] not in url_cache]
+        return results, await afetch_handles(url_to_fetch)
+
+    # Generate search intent, which does not block search and fetch
+    content = intent_prompt.format(research_question=research_question)
+    intent_response, (results, new_handles) = await asyncio.gather(
+        model.ainvoke(history_prompt(history, content)),
+        search_and_fetch(),
     )
-    response = model.invoke([SystemMessage(content)])
-    search_intent = response.content
-
-    # Execute search
-    if SEARCH_TOOL == "tavily":
-        results = search_tavily(query=query, max_results=SEARCH_TOP_K)
-    elif SEARCH_TOOL == "google":
-        results = search_google_serper(query=query, max_results=SEARCH_TOP_K)
-    else:
-        raise ValueError(f"Unknown search tool: {SEARCH_TOOL}")
-
-    # Fetch webpages
-    url_to_fetch = [result["url"] for result in results if result["url"] not in url_cache]
-    for url in url_to_fetch:
-        content = fetch_content(url)
-        url_cache[url] = content
+    search_intent = intent_response.content
 
     # Truncate contents
+    handles = {**url_cache, **new_handles}
+    contents = await aload_contents({
+        result["url"]: handles[result["url"]] for result in results
+    })
     for i, result in enumerate(results):
-        raw_content = url_cache[result["url"]]
+        raw_content = contents[result["url"]]
         # Retain more chars for higher rank documents
         if i < 5:
             context_chars = 4000
         else:
             context_chars = 2000
-        # Extract original contents according to snippet
+        # Extract original contents according to snippet, off the event loop
         if raw_content != "Can not fetch the page content.":
-            context = extract_context_by_snippet(
+            context = await asyncio.to_thread(
+                extract_context_by_snippet,
                 raw_content=raw_content,
                 snippet=result["snippet"],
                 context_chars=context_chars,
@@ -404,15 +419,14 @@ def search_query(
         search_intent=search_intent,
         search_results=formatted_results,
     )
-    response = model.invoke([SystemMessage(content)])
+    response = await model.ainvoke([SystemMessage(content)])
     final_information = response.content
 
-    # Update state
+    # Update state, parallel calls are merged by the reducers
     new_docs = [result["content"] for result in results]
-    retriever.add_documents(new_docs)
     return Command(update={
-        "url_cache": url_cache,
-        "retriever": retriever,
-        "total_interactions": total_interactions + 1,
+        "url_cache": new_handles,
+        "documents": new_docs,
+        "total_interactions": 1,
         "history": [ToolMessage(final_information, tool_call_id=tool_call_id)],
     })
@@ -0,0 +1,50 @@
+"""Merge results of shards and workers."""
+
+import argparse
+import json
+import os
+from typing import Dict, List
+
+from webthinker.evaluate import load_results
+
+
+def merge_results(paths: List[str]) -> List[Dict[str, str]]:
+    """Merge result files, preferring results without error."""
+    merged = {}
+    for path in paths:
+        for result in load_results(path):
+            previous = merged.get(result["id"])
+            if previous is None or previous.get("error") or not result.get("error"):
+                merged[result["id"]] = result
+    return sorted(merged.values(), key=lambda x: x["id"])
+
+
+def main():
+    """Merge results into a single results.jsonl."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--paths",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+    )
+    args = parser.parse_args()
+
+    # Accept output directories as well as result files
+    paths = [
+        os.path.join(path, "results.jsonl") if os.path.isdir(path) else path
+        for path in args.paths
+    ]
+    results = merge_results(paths)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    print(f"Merged {len(results)} results into {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,292 @@
 """Model."""
 
+import asyncio
+import collections
+import threading
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+import httpx
 from langchain_core.language_models import LanguageModelLike
 from langchain_qwq import ChatQwen, ChatQwQ
 
-from webthinker.config import (BASEURL, EVALUATION_MODEL, PLANNER_MODEL,
-                               REPETITION_PENALTY, SEED, SUPERVISOR_MODEL,
-                               TEMPERATURE, TOP_K, TOP_P, WRITER_MODEL)
+from webthinker.config import (BASEURL, EVALUATION_MODEL, LLM_KEEPALIVE_EXPIRY,
+                               LLM_MAX_CONCURRENCY, LLM_MAX_CONNECTIONS,
+                               LLM_TIMEOUT, PLANNER_MODEL, REPETITION_PENALTY,
+                               SEED, SUPERVISOR_MODEL, TEMPERATURE, TOP_K,
+                               TOP_P, WRITER_MODEL)
+
+_MODELS: Dict[str, LanguageModelLike] = {}
+_MODELS_LOCK = threading.Lock()
+_HTTP_CLIENTS: Tuple[httpx.Client, httpx.AsyncClient] = ()
+_HTTP_CLIENTS_LOCK = threading.Lock()
+_LLM_LIMITER: Optional["ConcurrencyLimiter"] = None
+_LLM_LIMITER_LOCK = threading.Lock()
+_CONNECTION_STATS = {"requests": 0, "connections": 0, "tls_handshakes": 0}
+_CONNECTION_STATS_LOCK = threading.Lock()
+
+
+###################
+# Concurrency limit
+###################
+class ConcurrencyLimiter:
+    """Limit of concurrent calls shared by all threads and event loops.
+
+    Slots are handed to waiters in arrival order.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters: Deque[Callable[[], None]] = collections.deque()
+        self._lock = threading.Lock()
+
+    def set_limit(self, limit: int):
+        """Change the limit, waking the waiters it lets in."""
+        with self._lock:
+            self.limit = limit
+            self._wake()
+
+    def _wake(self):
+        """Hand the free slots to waiters, with the lock held."""
+        while self._waiters and self.active < self.limit:
+            self.active += 1
+            self._waiters.popleft()()
+
+    def acquire(self):
+        """Wait for a free slot in the current thread."""
+        event = threading.Event()
+        with self._lock:
+            self._waiters.append(event.set)
+            self._wake()
+        event.wait()
+
+    async def aacquire(self):
+        """Wait for a free slot in the current event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(
+                lambda: future.done() or future.set_result(None)
+            )
+
+        with self._lock:
+            self._waiters.append(grant)
+            self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = grant not in self._waiters
+                if not granted:
+                    self._waiters.remove(grant)
+            if granted:
+                self.release()
+            raise
+
+    def release(self):
+        """Free a slot."""
+        with self._lock:
+            self.active -= 1
+            self._wake()
+
+
+def get_llm_limiter() -> ConcurrencyLimiter:
+    """Get the limiter shared by all model calls."""
+    global _LLM_LIMITER     # pylint: disable=global-statement
+    with _LLM_LIMITER_LOCK:
+        if _LLM_LIMITER is None:
+            _LLM_LIMITER = ConcurrencyLimiter(LLM_MAX_CONCURRENCY)
+    return _LLM_LIMITER
+
+
+class _ReleasingStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """Response body freeing its slot once closed."""
+
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    def _done(self):
+        """Free the slot once."""
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._done()
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._done()
+
+
+class LimitedTransport(httpx.BaseTransport):
+    """Sync transport holding a slot of the LLM limiter per response."""
+
+    def __init__(self, transport: httpx.BaseTransport):
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = get_llm_limiter()
+        limiter.acquire()
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            limiter.release()
+            raise
+        response.stream = _ReleasingStream(response.stream, limiter.release)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+
+class AsyncLimitedTransport(httpx.AsyncBaseTransport):
+    """Async transport holding a slot of the LLM limiter per response."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = get_llm_limiter()
+        await limiter.aacquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            limiter.release()
+            raise
+        response.stream = _ReleasingStream(response.stream, limiter.release)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+####################
+# Connection pooling
+####################
+def _count_event(event: str):
+    """Count connection events of the LLM clients."""
+    key = {
+        "http11.send_request_headers.started": "requests",
+        "http2.send_request_headers.started": "requests",
+        "connection.connect_tcp.complete": "connections",
+        "connection.start_tls.complete": "tls_handshakes",
+    }.get(event)
+    if key is not None:
+        with _CONNECTION_STATS_LOCK:
+            _CONNECTION_STATS[key] += 1
+
+
+def _trace(event: str, info: dict):   # pylint: disable=unused-argument
+    """Trace extension of the sync client."""
+    _count_event(event)
+
+
+async def _atrace(event: str, info: dict):    # pylint: disable=unused-argument
+    """Trace extension of the async client."""
+    _count_event(event)
+
+
+def _add_trace(request: httpx.Request):
+    """Attach the trace extension to a sync request."""
+    request.extensions["trace"] = _trace
+
+
+async def _aadd_trace(request: httpx.Request):
+    """Attach the trace extension to an async request."""
+    request.extensions["trace"] = _atrace
+
+
+def get_http_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """Get the keep-alive HTTP clients shared by all models.
+
+    Requests wait for a slot of the LLM limiter, and the pools have a
+    connection for every slot.
+    """
+    global _HTTP_CLIENTS    # pylint: disable=global-statement
+    with _HTTP_CLIENTS_LOCK:
+        if not _HTTP_CLIENTS:
+            max_connections = max(LLM_MAX_CONNECTIONS, get_llm_limiter().limit)
+            limits = httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            )
+            # Wait for a free connection instead of raising PoolTimeout
+            timeout = httpx.Timeout(LLM_TIMEOUT, connect=10, pool=None)
+            _HTTP_CLIENTS = (
+                httpx.Client(
+                    transport=LimitedTransport(httpx.HTTPTransport(limits=limits)),
+                    timeout=timeout,
+                    event_hooks={"request": [_add_trace]},
+                ),
+                httpx.AsyncClient(
+                    transport=AsyncLimitedTransport(
+                        httpx.AsyncHTTPTransport(limits=limits),
+                    ),
+                    timeout=timeout,
+                    event_hooks={"request": [_aadd_trace]},
+                ),
+            )
+    return _HTTP_CLIENTS
+
+
+def get_connection_stats() -> Dict[str, int]:
+    """Get connection reuse metrics of the LLM clients."""
+    with _CONNECTION_STATS_LOCK:
+        stats = dict(_CONNECTION_STATS)
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+
+################
+# Model registry
+################
+def get_model(role: str) -> LanguageModelLike:
+    """Get the shared model of a role, built on first use."""
+    with _MODELS_LOCK:
+        if role not in _MODELS:
+            _MODELS[role] = _MODEL_BUILDERS[role]()
+        return _MODELS[role]
 
 
 def get_planner_model() -> LanguageModelLike:
     """Get planner model."""
+    return get_model("planner")
+
+
+def get_supervisor_model() -> LanguageModelLike:
+    """Get supervisor model."""
+    return get_model("supervisor")
+
+
+def get_writer_model() -> LanguageModelLike:
+    """Get writer model."""
+    return get_model("writer")
+
+
+def get_evaluation_model() -> LanguageModelLike:
+    """Get evaluation model."""
+    return get_model("evaluation")
+
+
+def _build_planner_model() -> LanguageModelLike:
+    """Build planner model."""
+    http_client, http_async_client = get_http_clients()
     return ChatQwen(
         name=PLANNER_MODEL,
         base_url=BASEURL,
@@ -21,11 +298,14 @@ def get_planner_model() -> LanguageModelLike:
             "repetition_penalty": REPETITION_PENALTY,
         },
         seed=SEED,
+        http_client=http_client,
+        http_async_client=http_async_client,
     )
 
 
-def get_supervisor_model() -> LanguageModelLike:
-    """Get supervisor model."""
+def _build_supervisor_model() -> LanguageModelLike:
+    """Build supervisor model."""
+    http_client, http_async_client = get_http_clients()
     if SUPERVISOR_MODEL.startswith("qwq"):
         return ChatQwQ(
             name=SUPERVISOR_MODEL,
@@ -37,6 +317,8 @@ def get_supervisor_model() -> LanguageModelLike:
                 "repetition_penalty": REPETITION_PENALTY,
             },
             seed=SEED,
+            http_client=http_client,
+            http_async_client=http_async_client,
         )
     return ChatQwen(
         name=SUPERVISOR_MODEL,
@@ -49,11 +331,14 @@ def get_supervisor_model() -> LanguageModelLike:
             "repetition_penalty": REPETITION_PENALTY,
         },
         seed=SEED,
+        http_client=http_client,
+        http_async_client=http_async_client,
     )
 
 
-def get_writer_model() -> LanguageModelLike:
-    """Get writer model."""
+def _build_writer_model() -> LanguageModelLike:
+    """Build writer model."""
+    http_client, http_async_client = get_http_clients()
     return ChatQwen(
         name=WRITER_MODEL,
         base_url=BASEURL,
@@ -65,11 +350,14 @@ def get_writer_model() -> LanguageModelLike:
             "repetition_penalty": REPETITION_PENALTY,
         },
         seed=SEED,
+        http_client=http_client,
+        http_async_client=http_async_client,
     )
 
 
-def get_evaluation_model() -> LanguageModelLike:
-    """Get evaluation model."""
+def _build_evaluation_model() -> LanguageModelLike:
+    """Build evaluation model."""
+    http_client, http_async_client = get_http_clients()
     return ChatQwen(
         name=EVALUATION_MODEL,
         base_url=BASEURL,
@@ -81,4 +369,14 @@ def get_evaluation_model() -> LanguageModelLike:
             "repetition_penalty": REPETITION_PENALTY,
         },
         seed=SEED,
+        http_client=http_client,
+        http_async_client=http_async_client,
     )
+
+
+_MODEL_BUILDERS: Dict[str, Callable[[], LanguageModelLike]] = {
+    "planner": _build_planner_model,
+    "supervisor": _build_supervisor_model,
+    "writer": _build_writer_model,
+    "evaluation": _build_evaluation_model,
+}
@@ -54,10 +54,15 @@ SUPERVISOR_PROMPT = (
     "{research_question}\n"
 )
 
+NEXT_TOOL_CALL_PROMPT = "Please generate next tool call."
+
+PREVIOUS_THOUGHTS_PROMPT = (
+    "Previous thoughts:\n"
+    "{previous_thoughts}\n"
+)
+
 SEARCH_INTENT_PROMPT = (
     "Based on the previous thoughts, provide the detailed intent of the latest search query.\n"
-    "Previous thoughts: \n"
-    "{previous_thoughts}\n"
     "Please provide the current search intent.\n"
 )
 
@@ -95,8 +100,6 @@ EXTRACT_INFORMATION_PROMPT = (
 SUMMARIZE_SOLUTION_PROMPT = (
     "You are a research assistant to solve user's research questions.\n"
     "Based on the previous thoughts, summarize the answer to the question:\n"
-    "Previous thoughts:\n"
-    "{previous_thoughts}\n"
     "Question:\n"
     "{research_question}\n"
     "\n"
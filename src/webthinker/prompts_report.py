@@ -135,7 +135,8 @@ TITLE_PROMPT = (
 
 WRITE_SECTION_PROMPT = (
     "You are a research paper writing assistant. Please write a complete and "
-    "comprehensive \"{section_title}\" section based on the following information.\n"
+    "comprehensive \"{section_title}\" section based on the previous thoughts "
+    "and the following information.\n"
     "\n"
     "Potential helpful documents:\n"
     "{relevant_documents}\n"
@@ -143,9 +144,6 @@ WRITE_SECTION_PROMPT = (
     "Original question:\n"
     "{research_question}\n"
     "\n"
-    "Previous thoughts:\n"
-    "{previous_thoughts}\n"
-    "\n"
     "Outline of current written article:\n"
     "{article_outline}\n"
     "\n"
@@ -186,11 +184,11 @@ EDIT_ARTICLE_PROMPT = (
     "Please provide the complete modified article in markdown format.\n"
 )
 
+NEXT_TOOL_CALL_PROMPT = "Please generate next tool call."
+
 SEARCH_INTENT_PROMPT = (
     "Based on the previous thoughts, provide the detailed intent of the latest search query.\n"
     "Original question: {research_question}\n"
-    "Previous thoughts: \n"
-    "{previous_thoughts}\n"
     "Please provide the current search intent.\n"
 )
 
@@ -0,0 +1,235 @@
+"""Record and replay of searches, fetches and LLM calls."""
+
+import asyncio
+import functools
+import hashlib
+import json
+import threading
+import time
+from contextvars import ContextVar
+from typing import (Any, Callable, Dict, List, Literal, Optional, Sequence,
+                    Tuple)
+
+from langchain_core.caches import BaseCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+
+from webthinker.cache import SQLiteStore
+
+# Fields identifying a message in an LLM call, others are run-specific ids
+MESSAGE_KEY_FIELDS = ("type", "content", "name", "tool_calls", "tool_call_id")
+
+
+class ReplayMissError(LookupError):
+    """Raised when a call is not found in the replayed archive."""
+
+
+class Archive(SQLiteStore):
+    """Archive of external calls made during a run.
+
+    Records are keyed by (kind, key, seq), where seq counts the calls with
+    the same key, so that repeated sampling of the same prompt is replayed
+    in order. Each record keeps its latency to simulate it on replay.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS records ("
+        "kind TEXT, key TEXT, seq INTEGER, value TEXT, latency REAL, "
+        "PRIMARY KEY (kind, key, seq));"
+    )
+
+    def __init__(
+        self,
+        path: str,
+        mode: Literal["record", "replay"],
+        latency_scale: float = 0.,
+    ):
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._seqs: Dict[tuple, int] = {}
+        self._seqs_lock = threading.Lock()
+        super().__init__(path)
+
+    @staticmethod
+    def make_key(payload: Any) -> str:
+        """Hash call arguments into a key."""
+        data = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _next_seq(self, kind: str, key: str) -> int:
+        """Count calls with the same key."""
+        with self._seqs_lock:
+            seq = self._seqs.get((kind, key), 0)
+            self._seqs[(kind, key)] = seq + 1
+        return seq
+
+    def record(self, kind: str, key: str, value: str, latency: float):
+        """Record the result of a call."""
+        seq = self._next_seq(kind, key)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)",
+                (kind, key, seq, value, latency),
+            )
+
+    async def areplay(self, kind: str, key: str) -> str:
+        """Replay the result of a call without blocking the event loop."""
+        value, latency = await asyncio.to_thread(self.lookup, kind, key)
+        await self.asleep(latency)
+        return value
+
+    async def asleep(self, latency: float):
+        """Simulate recorded latency without blocking the event loop."""
+        if self.latency_scale > 0:
+            await asyncio.sleep(latency * self.latency_scale)
+
+    def lookup(self, kind: str, key: str) -> tuple:
+        """Get the recorded value and latency of the next call."""
+        seq = self._next_seq(kind, key)
+        rows = self.conn.execute(
+            "SELECT value, latency FROM records "
+            "WHERE kind = ? AND key = ? ORDER BY seq",
+            (kind, key),
+        ).fetchall()
+        if not rows:
+            raise ReplayMissError(f"No recorded {kind} call for key {key}.")
+        # Calls sampled more often than recorded reuse the last record
+        return rows[min(seq, len(rows) - 1)]
+
+
+def llm_call_key(prompt: str, llm_string: str) -> str:
+    """Key of an LLM call, ignoring the run-specific ids of its messages.
+
+    Langchain serializes the messages of a call into ``prompt``, including
+    the uuids that add_messages gives them, which differ in every run.
+    """
+    try:
+        messages = json.loads(prompt)
+    except json.JSONDecodeError:
+        messages = None
+    if isinstance(messages, list):
+        prompt = [
+            [m.get("kwargs", {}).get(field) for field in MESSAGE_KEY_FIELDS]
+            for m in messages
+        ]
+    return Archive.make_key([prompt, llm_string])
+
+
+# Key and start time of the LLM call recorded in the current context
+_CALL_STARTED: ContextVar[Optional[Tuple[str, float]]] = ContextVar(
+    "webthinker_llm_call_started", default=None,
+)
+
+
+class ArchiveLLMCache(BaseCache):
+    """LLM cache that records or replays chat model responses.
+
+    Langchain looks up and updates the cache of a call in the same context,
+    so each recorded call is timed from a context variable.
+    """
+
+    def __init__(self, archive: Archive):
+        self.archive = archive
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        """Replay a response, or start timing a recorded call."""
+        key = llm_call_key(prompt, llm_string)
+        if self.archive.mode == "replay":
+            # Sync calls, such as batched judgments, block their thread anyway
+            value, latency = self.archive.lookup("llm", key)
+            time.sleep(latency * self.archive.latency_scale)
+            return loads(value)
+        _CALL_STARTED.set((key, time.perf_counter()))
+        return None
+
+    async def alookup(
+        self,
+        prompt: str,
+        llm_string: str,
+    ) -> Optional[Sequence[Generation]]:
+        """Replay a response without blocking the event loop."""
+        if self.archive.mode != "replay":
+            return self.lookup(prompt, llm_string)
+        key = llm_call_key(prompt, llm_string)
+        return loads(await self.archive.areplay("llm", key))
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]):
+        """Record a response."""
+        if self.archive.mode != "record":
+            return
+        key = llm_call_key(prompt, llm_string)
+        now = time.perf_counter()
+        started = _CALL_STARTED.get()
+        latency = now - started[1] if started and started[0] == key else 0.
+        self.archive.record("llm", key, dumps(return_val), latency)
+
+    def clear(self, **kwargs: Any):
+        """Archives are never cleared by langchain."""
+
+
+def replayable(kind: str) -> Callable:
+    """Decorate a coroutine function whose JSON result is recorded or replayed."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            archive = get_archive()
+            if archive is None:
+                return await func(*args, **kwargs)
+            key = Archive.make_key([func.__name__, args, kwargs])
+            if archive.mode == "replay":
+                return json.loads(await archive.areplay(kind, key))
+            start = time.perf_counter()
+            result = await func(*args, **kwargs)
+            await asyncio.to_thread(
+                archive.record, kind, key, json.dumps(result, ensure_ascii=False),
+                time.perf_counter() - start,
+            )
+            return result
+        return wrapper
+    return decorator
+
+
+def record_pages(contents: Dict[str, str], latency: float):
+    """Record fetched pages, each with the latency of the whole batch."""
+    archive = get_archive()
+    for url, content in contents.items():
+        archive.record("page", Archive.make_key(url), content, latency)
+
+
+def _lookup_pages(urls: List[str]) -> Tuple[Dict[str, str], float]:
+    """Look up recorded pages and the latency of their concurrent batch."""
+    archive = get_archive()
+    contents, latency = {}, 0.
+    for url in dict.fromkeys(urls):
+        content, page_latency = archive.lookup("page", Archive.make_key(url))
+        contents[url] = content
+        latency = max(latency, page_latency)
+    return contents, latency
+
+
+async def areplay_pages(urls: List[str]) -> Dict[str, str]:
+    """Replay fetched pages without blocking the event loop."""
+    contents, latency = await asyncio.to_thread(_lookup_pages, urls)
+    await get_archive().asleep(latency)
+    return contents
+
+
+_ARCHIVE: Optional[Archive] = None
+
+
+def get_archive() -> Optional[Archive]:
+    """Get the archive of the current run, None in live mode."""
+    return _ARCHIVE
+
+
+def enable_archive(
+    path: str,
+    mode: Literal["record", "replay"],
+    latency_scale: float = 0.,
+) -> Archive:
+    """Record or replay all searches, fetches and LLM calls of the process."""
+    global _ARCHIVE     # pylint: disable=global-statement
+    _ARCHIVE = Archive(path, mode, latency_scale)
+    set_llm_cache(ArchiveLLMCache(_ARCHIVE))
+    return _ARCHIVE
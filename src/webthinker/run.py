@@ -1,16 +1,41 @@
 """Run solution experiments."""
 
 import argparse
+import asyncio
 import json
 import os
+import socket
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 import nltk
 
-from webthinker.config import NLTK_DATA_PATH
-from webthinker.evaluate import evaluate_qa, identify_group
+from webthinker.cache import get_search_cache
+from webthinker.config import LLM_MAX_CONCURRENCY, NLTK_DATA_PATH
+from webthinker.crawler import get_crawler_pool
+from webthinker.evaluate import (StreamingEvaluator, identify_group,
+                                 load_results)
 from webthinker.graph import webthinker
+from webthinker.model import get_connection_stats, get_llm_limiter
+from webthinker.replay import enable_archive
+from webthinker.utils import ainvoke_resumable, close_log, open_checkpointer
+from webthinker.workqueue import WorkQueue
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a shard given as "i/n" with 0 <= i < n."""
+    try:
+        shard, num_shards = (int(i) for i in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"shard must be given as i/n, got {value!r}"
+        ) from None
+    if not 0 <= shard < num_shards:
+        raise argparse.ArgumentTypeError(
+            f"shard must satisfy 0 <= i < n, got {value!r}"
+        )
+    return shard, num_shards
 
 
 def get_args():
@@ -32,6 +57,57 @@ def get_args():
         action="store_true",
         default=False
     )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--max_llm_concurrency",
+        type=int,
+        default=LLM_MAX_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--search_cache_only",
+        action="store_true",
+        default=False
+    )
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument(
+        "--record",
+        type=str,
+        default=None,
+    )
+    archive_group.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--replay_latency",
+        type=float,
+        default=0.,
+    )
     parser.add_argument(
         "--llm_eval",
         action="store_true",
@@ -40,6 +116,144 @@ def get_args():
     return parser.parse_args()
 
 
+def append_result(fp: str, result: Dict):
+    """Append a result to a jsonl file and flush it to disk."""
+    data = (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+    with open(fp, "ab+") as f:
+        # Terminate the line torn by a previous crash
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                data = b"\n" + data
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def solve_task(agent, task: Dict, output_dir: str, dataset: str) -> Dict:
+    """Solve a task."""
+    log_file = os.path.join(output_dir, f"{task['id']:0>2}.log")
+    try:
+        response = await ainvoke_resumable(
+            agent,
+            {
+                "research_question": task["Question"],
+                "log_file": log_file,
+            },
+            {
+                "recursion_limit": 200,
+                "configurable": {"thread_id": f"{dataset}_{task['id']}"},
+            },
+        )
+        solution = response.get("solution", "")
+        error = None
+    except Exception as e:
+        solution = ""
+        error = repr(e)
+    finally:
+        close_log(log_file)
+
+    return {
+        "id": task["id"],
+        "question": task["Question"],
+        "label": task["answer"],
+        "pred": solution,
+        "group": identify_group(task),
+        "error": error,
+    }
+
+
+async def keep_lease(queue: WorkQueue, worker: str, task_id: int):
+    """Renew the lease of a claimed task until cancelled, or lost."""
+    while True:
+        await asyncio.sleep(queue.lease / 3)
+        if not await asyncio.to_thread(queue.heartbeat, worker, task_id):
+            return
+
+
+async def solve_tasks(
+    tasks: List[Dict],
+    output_dir: str,
+    dataset: str,
+    concurrency: int = 1,
+    checkpoint: Optional[str] = None,
+    queue: Optional[WorkQueue] = None,
+    evaluator: Optional[StreamingEvaluator] = None,
+) -> List[Dict]:
+    """Solve tasks concurrently, appending results in completion order.
+
+    All tasks share a single event loop, and the LLM limiter bounds the
+    in-flight LLM requests of all tasks together. Each result
+    is appended to results.jsonl as soon as its task is done. With a
+    checkpoint file, interrupted trajectories resume from their last
+    completed node. With a work queue, tasks are claimed from the queue
+    shared with other workers instead. With an evaluator, each result is
+    evaluated as soon as its task is done.
+    """
+    task_by_id = {task["id"]: task for task in tasks}
+    pending = list(task_by_id)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    if queue is not None:
+        queue.add(pending)
+
+    async def claim() -> Optional[int]:
+        if queue is None:
+            return pending.pop(0) if pending else None
+        return await asyncio.to_thread(queue.claim, worker, list(task_by_id))
+
+    results = []
+    async with open_checkpointer(checkpoint) as checkpointer:
+        agent = webthinker(checkpointer=checkpointer)
+
+        async def solve(task_id: int) -> Optional[Dict]:
+            """Solve a task, None if its lease is lost meanwhile."""
+            solving = solve_task(agent, task_by_id[task_id], output_dir, dataset)
+            if queue is None:
+                return await solving
+            solving = asyncio.ensure_future(solving)
+            heartbeat = asyncio.ensure_future(keep_lease(queue, worker, task_id))
+            try:
+                await asyncio.wait(
+                    [solving, heartbeat], return_when=asyncio.FIRST_COMPLETED,
+                )
+                lost = heartbeat.done()
+            finally:
+                heartbeat.cancel()
+                if not solving.done():
+                    solving.cancel()
+                    await asyncio.gather(solving, return_exceptions=True)
+            if lost:
+                # Another worker owns the task now, and records its result
+                print(f"Lost the lease of task {task_id}, dropped it.")
+                return None
+            return solving.result()
+
+        async def work():
+            while (task_id := await claim()) is not None:
+                if (result := await solve(task_id)) is None:
+                    continue
+                append_result(os.path.join(output_dir, "results.jsonl"), result)
+                results.append(result)
+                if evaluator is not None:
+                    evaluator.add(result)
+                if queue is None:
+                    print(f"Task {task_id} done ({len(results)}/{len(tasks)}).")
+                    continue
+                # Release the task only after its result is on disk
+                if result["error"]:
+                    await asyncio.to_thread(queue.fail, worker, task_id)
+                else:
+                    await asyncio.to_thread(queue.complete, worker, task_id)
+                counts = await asyncio.to_thread(queue.counts)
+                print(
+                    f"Task {task_id} done ({len(results)} by this worker, "
+                    f"{counts.get('done', 0)}/{sum(counts.values())} in the queue)."
+                )
+
+        await asyncio.gather(*(work() for _ in range(concurrency)))
+    return results
+
+
 def main():
     """Main function."""
     load_dotenv()
@@ -47,17 +261,31 @@ def main():
 
     # Set paths
     nltk.data.path.append(NLTK_DATA_PATH)
-    subdir = f"webthinker_{args.dataset}_" + datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = os.path.join("outputs", subdir, args.dataset)
+    if args.resume:
+        output_dir = args.resume
+    else:
+        subdir = f"webthinker_{args.dataset}_" + datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_dir = os.path.join("outputs", subdir, args.dataset)
     os.makedirs(output_dir, exist_ok=True)
+    results_path = os.path.join(output_dir, "results.jsonl")
 
     # Set LangSmith
     if args.langsmith:
         os.environ["LANGSMITH_TRACING"] = "true"
         os.environ["LANGSMITH_PROJECT"] = "webthinker"
 
-    # Init agent
-    agent = webthinker()
+    # Set LLM concurrency
+    get_llm_limiter().set_limit(args.max_llm_concurrency)
+
+    # Set search cache
+    search_cache = get_search_cache()
+    search_cache.cache_only = args.search_cache_only
+
+    # Set record / replay
+    if args.record:
+        enable_archive(args.record, "record")
+    elif args.replay:
+        enable_archive(args.replay, "replay", args.replay_latency)
 
     # Read tasks
     fp = os.path.join("data", "datasets", f"{args.dataset}.json")
@@ -69,38 +297,48 @@ def main():
         selected_ids = [int(i) for i in args.ids.split(",")]
     else:
         selected_ids = [task["id"] for task in tasks]
-    results = []
-    for task in tasks:
-        if task["id"] not in selected_ids:
-            continue
-        try:
-            response = agent.invoke(
-                {
-                    "research_question": task["Question"],
-                    "log_file": os.path.join(output_dir, f"{task['id']:0>2}.log"),
-                },
-                {"recursion_limit": 200}
-            )
-            solution = response.get("solution", "")
-        except Exception:
-            solution = ""
-
-        results.append({
-            "id": task["id"],
-            "question": task["Question"],
-            "label": task["answer"],
-            "pred": solution,
-            "group": identify_group(task),
-        })
-
-    # Evaluate results
+    tasks = [task for task in tasks if task["id"] in selected_ids]
+    if args.shard:
+        shard, num_shards = args.shard
+        tasks = tasks[shard::num_shards]
+    run_ids = {task["id"] for task in tasks}
+    completed = [
+        result for result in load_results(results_path)
+        if result["id"] in run_ids and not result.get("error")
+    ]
+    completed_ids = {result["id"] for result in completed}
+    tasks = [task for task in tasks if task["id"] not in completed_ids]
+
+    # Evaluate results as tasks complete
+    evaluator = StreamingEvaluator(
+        os.path.join(output_dir, "performance.json"),
+        llm_eval=args.llm_eval,
+    )
+    for result in completed:
+        evaluator.add(result)
+    asyncio.run(solve_tasks(
+        tasks,
+        output_dir,
+        args.dataset,
+        concurrency=args.concurrency,
+        checkpoint=args.checkpoint,
+        queue=WorkQueue(args.queue) if args.queue else None,
+        evaluator=evaluator,
+    ))
+    performance = evaluator.finish()
+
+    # Save results
+    results = [
+        result for result in load_results(results_path)
+        if result["id"] in run_ids
+    ]
     with open(os.path.join(output_dir, "results.json"), "w", encoding="utf-8") as f:
         json.dump(results, f, indent=4, ensure_ascii=False)
 
-    performance = evaluate_qa(results, llm_eval=args.llm_eval)
     print("Performance:", performance)
-    with open(os.path.join(output_dir, "performance.json"), "w", encoding="utf-8") as f:
-        json.dump(performance, f, indent=4, ensure_ascii=False)
+    print("Search cache:", search_cache.stats)
+    print("Fetch:", get_crawler_pool().stats)
+    print("LLM connections:", get_connection_stats())
 
 
 if __name__ == "__main__":
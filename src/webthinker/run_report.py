@@ -1,15 +1,22 @@
 """Run report experiments."""
 
 import argparse
+import asyncio
 import json
 import os
 from datetime import datetime
+from typing import Dict, List, Optional
 
 from dotenv import load_dotenv
 import nltk
 
-from webthinker.config import NLTK_DATA_PATH
+from webthinker.cache import get_search_cache
+from webthinker.config import LLM_MAX_CONCURRENCY, NLTK_DATA_PATH
+from webthinker.crawler import get_crawler_pool
 from webthinker.graph_report import webthinker_report
+from webthinker.model import get_connection_stats, get_llm_limiter
+from webthinker.replay import enable_archive
+from webthinker.utils import ainvoke_resumable, close_log, open_checkpointer
 
 
 def get_args():
@@ -31,9 +38,83 @@ def get_args():
         action="store_true",
         default=False
     )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--max_llm_concurrency",
+        type=int,
+        default=LLM_MAX_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--search_cache_only",
+        action="store_true",
+        default=False
+    )
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument(
+        "--record",
+        type=str,
+        default=None,
+    )
+    archive_group.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--replay_latency",
+        type=float,
+        default=0.,
+    )
     return parser.parse_args()
 
 
+async def write_reports(
+    tasks: List[Dict],
+    output_dir: str,
+    dataset: str,
+    checkpoint: Optional[str] = None,
+):
+    """Write reports in a single event loop shared by all tool calls.
+
+    With a checkpoint file, interrupted trajectories resume from their
+    last completed node.
+    """
+    async with open_checkpointer(checkpoint) as checkpointer:
+        agent = webthinker_report(checkpointer=checkpointer)
+        for task in tasks:
+            log_file = os.path.join(output_dir, f"{task['id']:0>2}.log")
+            try:
+                response = await ainvoke_resumable(
+                    agent,
+                    {
+                        "research_question": task["Question"],
+                        "log_file": log_file,
+                    },
+                    {
+                        "recursion_limit": 200,
+                        "configurable": {"thread_id": f"{dataset}_{task['id']}"},
+                    },
+                )
+            finally:
+                close_log(log_file)
+            article = response.get("article", "")
+            fp = os.path.join(output_dir, f"{task['id']:0>2}.md")
+            with open(fp + ".tmp", "w", encoding="utf-8") as f:
+                f.write(article)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(fp + ".tmp", fp)
+
+
 def main():
     """Main function."""
     load_dotenv()
@@ -41,8 +122,11 @@ def main():
 
     # Set paths
     nltk.data.path.append(NLTK_DATA_PATH)
-    subdir = f"webthinker_{args.dataset}_" + datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = os.path.join("outputs", subdir, args.dataset)
+    if args.resume:
+        output_dir = args.resume
+    else:
+        subdir = f"webthinker_{args.dataset}_" + datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_dir = os.path.join("outputs", subdir, args.dataset)
     os.makedirs(output_dir, exist_ok=True)
 
     # Set LangSmith
@@ -50,8 +134,18 @@ def main():
         os.environ["LANGSMITH_TRACING"] = "true"
         os.environ["LANGSMITH_PROJECT"] = "webthinker"
 
-    # Init agent
-    agent = webthinker_report()
+    # Set LLM concurrency
+    get_llm_limiter().set_limit(args.max_llm_concurrency)
+
+    # Set search cache
+    search_cache = get_search_cache()
+    search_cache.cache_only = args.search_cache_only
+
+    # Set record / replay
+    if args.record:
+        enable_archive(args.record, "record")
+    elif args.replay:
+        enable_archive(args.replay, "replay", args.replay_latency)
 
     # Read tasks
     fp = os.path.join("data", "datasets", f"{args.dataset}.json")
@@ -63,20 +157,21 @@ def main():
         selected_ids = [int(i) for i in args.ids.split(",")]
     else:
         selected_ids = [task["id"] for task in tasks]
-    for task in tasks:
-        if task["id"] not in selected_ids:
-            continue
-        response = agent.invoke(
-            {
-                "research_question": task["Question"],
-                "log_file": os.path.join(output_dir, f"{task['id']:0>2}.log"),
-            },
-            {"recursion_limit": 200}
-        )
-        article = response.get("article", "")
-        fp = os.path.join(output_dir, f"{task['id']:0>2}.md")
-        with open(fp, "w", encoding="utf-8") as f:
-            f.write(article)
+    # Reports are written atomically, so existing ones are complete
+    tasks = [
+        task for task in tasks
+        if task["id"] in selected_ids
+        and not os.path.exists(os.path.join(output_dir, f"{task['id']:0>2}.md"))
+    ]
+    asyncio.run(write_reports(
+        tasks,
+        output_dir,
+        args.dataset,
+        checkpoint=args.checkpoint,
+    ))
+    print("Search cache:", search_cache.stats)
+    print("Fetch:", get_crawler_pool().stats)
+    print("LLM connections:", get_connection_stats())
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 """Schema."""
 
-from typing import Annotated, Any, Dict, Literal, Set, TypedDict
+import operator
+from typing import Annotated, Dict, List, Literal, Set, TypedDict
 
 from langgraph.graph.message import add_messages
 
@@ -25,18 +26,24 @@ class WebThinkerReportState(TypedDict):
     research_question: str
     log_file: str
 
+    # Identifies the run, e.g. to cache its retriever
+    run_id: str
+
     # Output
     article: str
+    # Headers of the article, indexed incrementally as sections are written
+    article_headers: List[Dict]
 
     # Supervisor
     plan: str
     history: Annotated[list, add_messages]
-    total_interactions: int
+    total_interactions: Annotated[int, operator.add]
     research_complete_flag: bool
 
-    # Search query
-    url_cache: Dict[str, str]
-    retriever: Any
+    # Search query, tools return increments merged by reducers
+    # url_cache maps urls to content digests of the fetched pages
+    url_cache: Annotated[Dict[str, str], operator.or_]
+    documents: Annotated[List[str], operator.add]
 
 
 ####################################
@@ -64,12 +71,13 @@ class WebThinkerSolutionState(TypedDict):
 
     # Supervisor
     history: Annotated[list, add_messages]
-    total_interactions: int
+    total_interactions: Annotated[int, operator.add]
     research_complete_flag: bool
 
-    # Search query
-    url_cache: Dict[str, str]
-    executed_search_queries: Set[str]
+    # Search query, tools return increments merged by reducers
+    # url_cache maps urls to content digests of the fetched pages
+    url_cache: Annotated[Dict[str, str], operator.or_]
+    executed_search_queries: Annotated[Set[str], operator.or_]
 
 
 ###################
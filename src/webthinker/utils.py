@@ -1,82 +1,331 @@
 """Utility functions."""
 
 import asyncio
+import functools
+import hashlib
+import io
 import json
 import logging
 import string
-from typing import Dict, List, Sequence, Set
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import (Any, AsyncIterator, Dict, List, Optional, Sequence, Set,
+                    Tuple)
 
 import nltk
 import numpy as np
-from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
 from langchain_community.utilities import GoogleSerperAPIWrapper
 from langchain_community.utilities.tavily_search import TavilySearchAPIWrapper
 from langchain_core.messages import (AIMessage, BaseMessage, ChatMessage,
                                      HumanMessage, SystemMessage, ToolMessage)
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.graph.state import CompiledStateGraph
 from mrkdwn_analysis import MarkdownAnalyzer
 from nltk.tokenize import word_tokenize
-from rank_bm25 import BM25Okapi
+from nltk.tokenize.punkt import PunktTokenizer
+
+from webthinker.cache import (cached_search, content_digest, get_blob_store,
+                              get_failure_cache, get_page_store)
+from webthinker.config import (COMPACTED_TOOL_OUTPUT_CHARS,
+                               HISTORY_RENDERER_CACHE_SIZE,
+                               RETRIEVER_CACHE_SIZE, SENTENCE_INDEX_CACHE_SIZE,
+                               SUPERVISOR_KEEP_RECENT, SUPERVISOR_TOKEN_BUDGET)
+from webthinker.crawler import FETCH_FAILED, get_crawler_pool
+from webthinker.prompts import PREVIOUS_THOUGHTS_PROMPT
+from webthinker.replay import (areplay_pages, get_archive, record_pages,
+                               replayable)
+
+
+_TASK_LOGGERS: Dict[Tuple[str, str], logging.Logger] = {}
+_LOG_HANDLERS: Dict[str, logging.FileHandler] = {}
+_TASK_LOGGERS_LOCK = threading.Lock()
 
 
 def get_logger(
     name: str,
     log_file: str = None,
 ) -> logging.Logger:
-    """Get logger."""
-    logger = logging.getLogger(name)
-    if logger.handlers:
-        for handler in logger.handlers:
-            logger.removeHandler(handler)
-    if log_file is not None:
-        file_handler = logging.FileHandler(log_file, encoding="utf-8")
-        logger.addHandler(file_handler)
+    """Get logger.
+
+    Loggers with a log file are private to that file, so that concurrent
+    tasks never write into each other's logs. They still propagate to the
+    named logger.
+    """
+    if log_file is None:
+        return logging.getLogger(name)
+    with _TASK_LOGGERS_LOCK:
+        logger = _TASK_LOGGERS.get((name, log_file))
+        if logger is None:
+            if log_file not in _LOG_HANDLERS:
+                _LOG_HANDLERS[log_file] = logging.FileHandler(log_file, encoding="utf-8")
+            logger = logging.Logger(name)
+            logger.parent = logging.getLogger(name)
+            logger.addHandler(_LOG_HANDLERS[log_file])
+            _TASK_LOGGERS[(name, log_file)] = logger
     return logger
 
 
+def close_log(log_file: str):
+    """Release the loggers and the file handler of a finished task."""
+    with _TASK_LOGGERS_LOCK:
+        for key in [key for key in _TASK_LOGGERS if key[1] == log_file]:
+            del _TASK_LOGGERS[key]
+        handler = _LOG_HANDLERS.pop(log_file, None)
+    if handler is not None:
+        handler.close()
+
+
+@asynccontextmanager
+async def open_checkpointer(
+    path: Optional[str] = None,
+) -> AsyncIterator[Optional[BaseCheckpointSaver]]:
+    """Open the SQLite checkpointer of a run, None if disabled."""
+    if path is None:
+        yield None
+        return
+    async with AsyncSqliteSaver.from_conn_string(path) as checkpointer:
+        yield checkpointer
+
+
+async def ainvoke_resumable(
+    agent: CompiledStateGraph,
+    inputs: Dict[str, Any],
+    config: RunnableConfig,
+) -> Dict[str, Any]:
+    """Invoke an agent, resuming its checkpointed trajectory if any."""
+    if agent.checkpointer is None:
+        return await agent.ainvoke(inputs, config)
+    snapshot = await agent.aget_state(config)
+    if snapshot.next:
+        # Resume an interrupted trajectory from its last completed node
+        return await agent.ainvoke(None, config)
+    if snapshot.values:
+        # The trajectory has already completed
+        return snapshot.values
+    return await agent.ainvoke(inputs, config)
+
+
+def render_message(
+    m: BaseMessage,
+    human_prefix: str = "Human",
+    ai_prefix: str = "AI",
+) -> str:
+    """Render a message, showing tool_calls of AI messages."""
+    if isinstance(m, HumanMessage):
+        role = human_prefix
+    elif isinstance(m, AIMessage):
+        role = ai_prefix
+    elif isinstance(m, SystemMessage):
+        role = "System"
+    elif isinstance(m, ToolMessage):
+        role = "Tool"
+    elif isinstance(m, ChatMessage):
+        role = m.role
+    else:
+        msg = f"Got unsupported message type: {m}"
+        raise ValueError(msg)  # noqa: TRY004
+    message = f"{role}: {m.text()}"
+    if isinstance(m, AIMessage) and m.tool_calls:
+        tool_calls = [
+            {"name": call["name"], "args": call["args"]}
+            for call in m.tool_calls
+        ]
+        message += f"{tool_calls}"
+    return message
+
+
+class HistoryRenderer:
+    """Append-only rendering of a message history.
+
+    Messages are matched with the previous rendering by id, content and
+    tool calls, so only new or edited messages are formatted. Since the
+    rendering only grows at its end, prompts starting with it share a
+    stable prefix across calls.
+    """
+
+    def __init__(self, human_prefix: str = "Human", ai_prefix: str = "AI"):
+        self.human_prefix = human_prefix
+        self.ai_prefix = ai_prefix
+        self.keys: List[tuple] = []
+        self.lines: List[str] = []
+        self.text = ""
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def message_key(m: BaseMessage) -> tuple:
+        """What the rendering of a message depends on."""
+        return (
+            m.id, type(m), m.content,
+            getattr(m, "role", None), getattr(m, "tool_calls", None),
+        )
+
+    def render(self, messages: Sequence[BaseMessage]) -> str:
+        """Render messages, formatting only the unseen ones."""
+        with self.lock:
+            # Keep the longest already rendered prefix
+            num_kept = 0
+            for m, rendered_key in zip(messages, self.keys):
+                if m.id is None or self.message_key(m) != rendered_key:
+                    break
+                num_kept += 1
+            if num_kept < len(self.keys):
+                del self.keys[num_kept:], self.lines[num_kept:]
+                self.text = "\n".join(self.lines)
+
+            new_lines = [
+                render_message(m, self.human_prefix, self.ai_prefix)
+                for m in messages[num_kept:]
+            ]
+            if new_lines:
+                self.keys.extend(self.message_key(m) for m in messages[num_kept:])
+                self.lines.extend(new_lines)
+                new_text = "\n".join(new_lines)
+                self.text = f"{self.text}\n{new_text}" if num_kept else new_text
+            return self.text
+
+
+_RENDERERS: "OrderedDict[tuple, HistoryRenderer]" = OrderedDict()
+_RENDERERS_LOCK = threading.Lock()
+
+
+def get_history_renderer(
+    messages: Sequence[BaseMessage],
+    human_prefix: str = "Human",
+    ai_prefix: str = "AI"
+) -> HistoryRenderer:
+    """Get the renderer of a history, identified by its first message."""
+    if not messages or messages[0].id is None:
+        return HistoryRenderer(human_prefix, ai_prefix)
+    key = (messages[0].id, human_prefix, ai_prefix)
+    with _RENDERERS_LOCK:
+        if key not in _RENDERERS:
+            _RENDERERS[key] = HistoryRenderer(human_prefix, ai_prefix)
+        _RENDERERS.move_to_end(key)
+        while len(_RENDERERS) > HISTORY_RENDERER_CACHE_SIZE:
+            _RENDERERS.popitem(last=False)
+        return _RENDERERS[key]
+
+
 def get_buffer_string(
     messages: Sequence[BaseMessage],
     human_prefix: str = "Human",
     ai_prefix: str = "AI"
 ) -> str:
     r"""Modify langchain function to correctly show tool_calls."""
-    string_messages = []
-    for m in messages:
-        if isinstance(m, HumanMessage):
-            role = human_prefix
-        elif isinstance(m, AIMessage):
-            role = ai_prefix
-        elif isinstance(m, SystemMessage):
-            role = "System"
-        elif isinstance(m, ToolMessage):
-            role = "Tool"
-        elif isinstance(m, ChatMessage):
-            role = m.role
-        else:
-            msg = f"Got unsupported message type: {m}"
-            raise ValueError(msg)  # noqa: TRY004
-        message = f"{role}: {m.text()}"
-        if isinstance(m, AIMessage) and m.tool_calls:
-            tool_calls = [
-                {"name": call["name"], "args": call["args"]}
-                for call in m.tool_calls
-            ]
-            message += f"{tool_calls}"
-        string_messages.append(message)
+    renderer = get_history_renderer(messages, human_prefix, ai_prefix)
+    return renderer.render(messages)
+
 
-    return "\n".join(string_messages)
+def history_prompt(
+    history: Sequence[BaseMessage],
+    content: str,
+) -> List[BaseMessage]:
+    """Build a prompt whose first message is the rendered history.
+
+    All prompts of a trajectory thus start with the same growing text,
+    which providers can reuse through prefix caching.
+    """
+    previous_thoughts = get_buffer_string(history)
+    return [
+        SystemMessage(PREVIOUS_THOUGHTS_PROMPT.format(previous_thoughts=previous_thoughts)),
+        SystemMessage(content),
+    ]
 
 
-def extract_outline(content: str) -> str:
-    """Extract outline of the article"""
-    analyzer = MarkdownAnalyzer.from_string(content)
-    results = analyzer.identify_headers()
-    outline = ""
-    for header in results["Header"]:
-        outline += f"{'#' * header['level']} {header['text']}\n"
-    return outline
+def estimate_tokens(m: BaseMessage) -> int:
+    """Roughly estimate the number of tokens of a message."""
+    text = m.text()
+    if isinstance(m, AIMessage) and m.tool_calls:
+        text += json.dumps([call["args"] for call in m.tool_calls], ensure_ascii=False)
+    # About 4 bytes per token, plus the overhead of the chat template
+    return len(text.encode("utf-8")) // 4 + 4
 
 
-def search_google_serper(
+def compact_history(
+    messages: Sequence[BaseMessage],
+    nudge: str,
+    token_budget: int = SUPERVISOR_TOKEN_BUDGET,
+    keep_recent: int = SUPERVISOR_KEEP_RECENT,
+) -> Tuple[List[BaseMessage], int, int]:
+    """Compact a history to fit a token budget.
+
+    Repeated nudge messages are dropped except the latest one. If the
+    history still exceeds the budget, older tool outputs are truncated,
+    then omitted, from the oldest on. The first message and the most
+    recent ones are kept verbatim. Returns the compacted messages and the
+    estimated numbers of tokens before and after compaction.
+    """
+    num_tokens = sum(estimate_tokens(m) for m in messages)
+    compacted = [
+        m for i, m in enumerate(messages)
+        if not (
+            isinstance(m, SystemMessage) and m.content == nudge
+            and i != len(messages) - 1
+        )
+    ]
+    tokens = [estimate_tokens(m) for m in compacted]
+    old_tool_ids = [
+        i for i, m in enumerate(compacted[:len(compacted) - keep_recent])
+        if i > 0 and isinstance(m, ToolMessage)
+    ]
+    for content in (
+        lambda text: f"{text[:COMPACTED_TOOL_OUTPUT_CHARS]} ...[truncated]",
+        lambda text: "[Output omitted to save context.]",
+    ):
+        for i in old_tool_ids:
+            if sum(tokens) <= token_budget:
+                break
+            text = compacted[i].text()
+            new_text = content(text)
+            # Never lengthen outputs that are already short
+            if len(new_text) >= len(text):
+                continue
+            compacted[i] = compacted[i].model_copy(update={"content": new_text})
+            tokens[i] = estimate_tokens(compacted[i])
+    return compacted, num_tokens, sum(tokens)
+
+
+def index_headers(
+    article: str,
+    headers: Optional[List[Dict]] = None,
+) -> List[Dict]:
+    """Index the headers of an article, reusing the headers indexed so far.
+
+    The parser only looks forward, so parsing restarts at the last indexed
+    header and only the text appended after it is parsed again. The index
+    must be rebuilt from scratch once the article is edited elsewhere.
+    """
+    headers = list(headers or [])
+    # Text starting with "---" would be parsed as front matter
+    while headers and article.startswith("---", headers[-1]["offset"]):
+        headers.pop()
+    start = headers.pop()["offset"] if headers else 0
+    text = article[start:]
+    analyzer = MarkdownAnalyzer.from_string(text)
+    line_offsets = [0]
+    for line in text.split("\n"):
+        line_offsets.append(line_offsets[-1] + len(line) + 1)
+    for header in analyzer.identify_headers().get("Header", []):
+        headers.append({
+            "offset": start + line_offsets[header["line"] - 1],
+            "level": header["level"],
+            "text": header["text"],
+        })
+    return headers
+
+
+def format_outline(headers: List[Dict]) -> str:
+    """Format the outline of the article from its headers."""
+    return "".join(f"{'#' * header['level']} {header['text']}\n" for header in headers)
+
+
+@replayable("search")
+@cached_search("google")
+async def search_google_serper(
     query: str,
     max_results: int
 ) -> List[Dict[str, str]]:
@@ -86,7 +335,7 @@ def search_google_serper(
         type="search",  # organic
         k=max_results,
     )
-    results = search.results(query)
+    results = await search.aresults(query)
 
     # Convert results
     if "organic" in results:
@@ -105,13 +354,15 @@ def search_google_serper(
     return search_results
 
 
-def search_tavily(
+@replayable("search")
+@cached_search("tavily")
+async def search_tavily(
     query: str,
     max_results: int
 ) -> List[Dict[str, str]]:
     """Search query from tavily."""
     search = TavilySearchAPIWrapper()
-    results = search.results(
+    results = await search.results_async(
         query=query,
         max_results=max_results,
         search_depth="basic",
@@ -129,49 +380,224 @@ def search_tavily(
     ]
 
 
-def fetch_content(url: str) -> str:
-    """Fetch webpage content."""
-    async def fetch_content_async(url: str) -> str:
-        """Async function to fetch webpage content."""
-        browser_config = BrowserConfig(
-            verbose=True,
-            text_mode=True,
-        )
-        run_config = CrawlerRunConfig(
-            verbose=True,
-            scan_full_page=True,
-            # exclude_external_links=True,
-        )
-        async with AsyncWebCrawler(
-            config=browser_config,
-        ) as crawler:
-            result = await crawler.arun(
-                url,
-                config=run_config,
-            )
-        if result.success and result.markdown.strip():
-            md_content = result.markdown.strip()
-        else:
-            md_content = "Can not fetch the page content."
-        return md_content
-    return asyncio.run(fetch_content_async(url))
+async def afetch_contents(urls: List[str]) -> Dict[str, str]:
+    """Fetch webpage contents concurrently, in the order of urls.
+
+    Pages are read through the persistent page store, only missing or
+    expired pages are fetched by the crawler pool. Urls and hosts that
+    failed recently are skipped without fetching.
+    """
+    archive = get_archive()
+    if archive is not None and archive.mode == "replay":
+        return await areplay_pages(urls)
+
+    start = time.perf_counter()
+    contents, missing = await asyncio.to_thread(_load_pages, urls)
+    # Never start the crawler pool when all pages are stored or blocked
+    fetched = await get_crawler_pool().afetch_many(missing) if missing else {}
+    return await asyncio.to_thread(_store_pages, urls, contents, fetched, start)
+
+
+async def afetch_handles(urls: List[str]) -> Dict[str, str]:
+    """Fetch webpages into the blob store, returning their content digests."""
+    contents = await afetch_contents(urls)
+    return await asyncio.to_thread(get_blob_store().put_many, contents)
+
+
+async def aload_contents(handles: Dict[str, str]) -> Dict[str, str]:
+    """Load the contents of the urls in handles from the blob store.
+
+    Contents evicted since their urls were fetched are fetched again.
+    """
+    blob_store = get_blob_store()
+    contents = await asyncio.to_thread(blob_store.get_many, list(handles.values()))
+    missing = [url for url, digest in handles.items() if digest not in contents]
+    fetched = await afetch_contents(missing) if missing else {}
+    if fetched:
+        await asyncio.to_thread(blob_store.put_many, fetched)
+    return {
+        url: fetched[url] if url in fetched else contents[digest]
+        for url, digest in handles.items()
+    }
+
+
+def _load_pages(urls: List[str]) -> Tuple[Dict[str, str], List[str]]:
+    """Load stored pages and blocked urls, and list the pages to fetch."""
+    contents = get_page_store().get_many(urls)
+    missing = [url for url in urls if url not in contents]
+    for url in get_failure_cache().blocked(missing):
+        contents[url] = FETCH_FAILED
+    missing = [url for url in missing if url not in contents]
+    return contents, missing
+
+
+def _store_pages(
+    urls: List[str],
+    contents: Dict[str, str],
+    fetched: Dict[str, Optional[str]],
+    start: float,
+) -> Dict[str, str]:
+    """Store fetched pages with their sentence indexes.
+
+    Pages cancelled by the fetch deadline are None in fetched. They fail
+    for this call, but are not counted against their urls and hosts.
+    """
+    get_failure_cache().update(
+        {url: content for url, content in fetched.items() if content is not None},
+        failed=FETCH_FAILED,
+    )
+    fetched = {
+        url: FETCH_FAILED if content is None else content
+        for url, content in fetched.items()
+    }
+    fetched_pages, sentence_indexes = {}, {}
+    for url, content in fetched.items():
+        if content == FETCH_FAILED:
+            continue
+        sentence_index = SentenceIndex.build(content)
+        cache_sentence_index(content_digest(content), sentence_index)
+        fetched_pages[url] = content
+        sentence_indexes[url] = sentence_index.to_bytes()
+    get_page_store().put_many(fetched_pages, sentence_indexes)
+    contents.update(fetched)
+    contents = {url: contents[url] for url in dict.fromkeys(urls)}
+
+    if get_archive() is not None:
+        record_pages(contents, time.perf_counter() - start)
+    return contents
+
+
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
 
 
 def bag_of_words(sent: str) -> Set[str]:
     """Convert a sentence into a bag of words."""
     # Remove punctuation in sentence
-    sent = sent.translate(str.maketrans("", "", string.punctuation))
+    sent = sent.translate(PUNCTUATION_TABLE)
     return set(sent.lower().split())
 
 
-def f1_score(true_set: Set[str], pred_set: Set[str]) -> float:
-    """Compute F1 score of two sets."""
-    intersection = true_set.intersection(pred_set)
-    if intersection:
-        p = len(intersection) / len(pred_set)
-        r = len(intersection) / len(true_set)
-        return 2 * p * r / (p + r)
-    return 0.
+def hash_words(words: Set[str]) -> np.ndarray:
+    """Hash words into stable 64-bit integers."""
+    return np.array(
+        [
+            int.from_bytes(
+                hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(),
+                "little",
+                signed=True,
+            )
+            for word in words
+        ],
+        dtype=np.int64,
+    )
+
+
+class SentenceIndex:
+    """Precomputed sentences of a page for snippet matching.
+
+    Stores the character span of each sentence and its hashed bag of words
+    as one flat array, so that matching a snippet is a single vectorized
+    pass without re-tokenizing the page.
+    """
+
+    def __init__(
+        self,
+        spans: np.ndarray,
+        word_hashes: np.ndarray,
+        word_sents: np.ndarray,
+    ):
+        self.spans = spans
+        self.word_hashes = word_hashes
+        self.word_sents = word_sents
+        self.sizes = np.bincount(word_sents, minlength=len(spans))
+
+    @classmethod
+    def build(cls, content: str) -> "SentenceIndex":
+        """Split and index the sentences of a page."""
+        spans = list(get_sentence_tokenizer().span_tokenize(content))
+        word_hashes, word_sents = [], []
+        for i, (start, end) in enumerate(spans):
+            hashes = hash_words(bag_of_words(content[start:end]))
+            word_hashes.append(hashes)
+            word_sents.append(np.full(len(hashes), i, dtype=np.int32))
+        return cls(
+            spans=np.array(spans, dtype=np.int64).reshape(-1, 2),
+            word_hashes=np.concatenate(word_hashes or [np.empty(0, np.int64)]),
+            word_sents=np.concatenate(word_sents or [np.empty(0, np.int32)]),
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SentenceIndex":
+        """Deserialize the index."""
+        arrays = np.load(io.BytesIO(data))
+        return cls(arrays["spans"], arrays["word_hashes"], arrays["word_sents"])
+
+    def to_bytes(self) -> bytes:
+        """Serialize the index."""
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            spans=self.spans,
+            word_hashes=self.word_hashes,
+            word_sents=self.word_sents,
+        )
+        return buffer.getvalue()
+
+    def best_span(self, snippet: str, min_f1: float = 0.2) -> Optional[tuple]:
+        """Get the span of the sentence best matching the snippet."""
+        snippet_hashes = hash_words(bag_of_words(snippet))
+        if not len(snippet_hashes) or not len(self.spans):
+            return None
+        matched = np.isin(self.word_hashes, snippet_hashes)
+        intersection = np.bincount(
+            self.word_sents[matched], minlength=len(self.spans),
+        )
+        # F1 of two bags of words is 2 * |A & B| / (|A| + |B|)
+        f1 = 2 * intersection / (len(snippet_hashes) + self.sizes)
+        best_sent_id = int(np.argmax(f1))
+        if f1[best_sent_id] <= min_f1:
+            return None
+        start, end = self.spans[best_sent_id]
+        return int(start), int(end)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sentence_tokenizer() -> PunktTokenizer:
+    """Get the sentence tokenizer used by nltk.sent_tokenize."""
+    return PunktTokenizer("english")
+
+
+_SENTENCE_INDEXES: "OrderedDict[str, SentenceIndex]" = OrderedDict()
+_SENTENCE_INDEXES_LOCK = threading.Lock()
+
+
+def get_sentence_index(content: str) -> SentenceIndex:
+    """Get the sentence index of a page content.
+
+    Indexes are looked up in a bounded in-process cache, then in the page
+    store, and only built when the page has never been indexed.
+    """
+    digest = content_digest(content)
+    with _SENTENCE_INDEXES_LOCK:
+        if digest in _SENTENCE_INDEXES:
+            _SENTENCE_INDEXES.move_to_end(digest)
+            return _SENTENCE_INDEXES[digest]
+    data = get_page_store().get_sentence_index(digest)
+    if data is not None:
+        sentence_index = SentenceIndex.from_bytes(data)
+    else:
+        sentence_index = SentenceIndex.build(content)
+    cache_sentence_index(digest, sentence_index)
+    return sentence_index
+
+
+def cache_sentence_index(digest: str, sentence_index: SentenceIndex):
+    """Keep a sentence index in the in-process cache."""
+    with _SENTENCE_INDEXES_LOCK:
+        _SENTENCE_INDEXES[digest] = sentence_index
+        _SENTENCE_INDEXES.move_to_end(digest)
+        while len(_SENTENCE_INDEXES) > SENTENCE_INDEX_CACHE_SIZE:
+            _SENTENCE_INDEXES.popitem(last=False)
 
 
 def extract_context_by_snippet(
@@ -180,24 +606,12 @@ def extract_context_by_snippet(
     context_chars: int = 4000,
 ) -> str:
     """Extract the context from document via snippet."""
-    # Split sentences
-    sents = nltk.sent_tokenize(raw_content)
-    snippet_words = bag_of_words(snippet)
     # Main idea is to find the most relevant sentence and expand the context
-    best_f1 = 0.2
-    best_sent_id = -1
-    for i, sent in enumerate(sents):
-        sent = sent.translate(str.maketrans("", "", string.punctuation))
-        sent_words = bag_of_words(sent)
-        f1 = f1_score(snippet_words, sent_words)
-        if f1 > best_f1:
-            best_f1, best_sent_id = f1, i
-
-    if best_sent_id >= 0:
-        key_sent = sents[best_sent_id]
-        sent_start = raw_content.find(key_sent)
+    span = get_sentence_index(raw_content).best_span(snippet)
+    if span is not None:
+        sent_start, sent_end = span
         start_idx = max(0, sent_start - context_chars)
-        return raw_content[start_idx:start_idx + len(key_sent) + context_chars]
+        return raw_content[start_idx:start_idx + sent_end - sent_start + context_chars]
 
     return raw_content[:2 * context_chars]
 
@@ -222,30 +636,124 @@ def format_search_results(
     return formatted_results
 
 
-class BM25Retriever:
-    """Modify BM25Retriever to support add_documents."""
+def grow_array(array: np.ndarray, size: int) -> np.ndarray:
+    """Grow an array to hold at least size items, doubling its capacity."""
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
 
-    def __init__(self):
-        self.docs = []
-        self.tokenized_docs = []
-        self.bm25 = None
+class BM25Retriever:
+    """Incremental BM25 retriever supporting add_documents.
+
+    Scores documents as rank_bm25.BM25Okapi does, but keeps an inverted
+    index with running document frequencies and lengths, so that adding
+    documents costs time proportional to the new documents only.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.docs: List[str] = []
+        self.vocab: Dict[str, int] = {}
+        # Postings of each term: document ids and term frequencies
+        self.postings: List[Tuple[List[int], List[int]]] = []
+        self.doc_freqs = np.zeros(0, dtype=np.int64)
+        self.doc_lens = np.zeros(0, dtype=np.int64)
+        self.total_len = 0
 
     def add_documents(self, docs: List[str]):
         """Add new documents to the retriever."""
-        # rank_bm25 does not support incremental updates, so we need to build all indices
-        self.docs.extend(docs)
-        self.tokenized_docs.extend([word_tokenize(doc.lower()) for doc in docs])
-        if self.tokenized_docs:
-            self.bm25 = BM25Okapi(self.tokenized_docs)
-        else:
-            self.bm25 = None
+        batch_term_ids, batch_doc_lens = [], []
+        for doc in docs:
+            doc_id = len(self.docs)
+            tokens = word_tokenize(doc.lower())
+            self.docs.append(doc)
+            batch_doc_lens.append(len(tokens))
+            for term, freq in Counter(tokens).items():
+                term_id = self.vocab.setdefault(term, len(self.vocab))
+                if term_id == len(self.postings):
+                    self.postings.append(([], []))
+                self.postings[term_id][0].append(doc_id)
+                self.postings[term_id][1].append(freq)
+                batch_term_ids.append(term_id)
+
+        # Update running statistics
+        self.doc_freqs = grow_array(self.doc_freqs, len(self.vocab))
+        np.add.at(self.doc_freqs, np.array(batch_term_ids, dtype=np.int64), 1)
+        num_docs = len(self.docs)
+        self.doc_lens = grow_array(self.doc_lens, num_docs)
+        self.doc_lens[num_docs - len(docs):num_docs] = batch_doc_lens
+        self.total_len += sum(batch_doc_lens)
 
     def invoke(self, query: str, k: int = 3) -> List[str]:
         """Retrieve top k documents for a given query."""
-        if self.bm25 is None:
+        if not self.docs:
             return []
 
-        tokenized_query = word_tokenize(query.lower())
-        doc_scores = self.bm25.get_scores(tokenized_query)
-        top_indices = np.argsort(doc_scores)[-k:][::-1]
+        doc_scores = self.get_scores(word_tokenize(query.lower()))
+        k = min(k, len(self.docs))
+        top_indices = np.argpartition(-doc_scores, k - 1)[:k]
+        top_indices = top_indices[np.argsort(-doc_scores[top_indices], kind="stable")]
         return [self.docs[i] for i in top_indices]
+
+    def get_scores(self, tokenized_query: List[str]) -> np.ndarray:
+        """Score all documents against a query."""
+        num_docs = len(self.docs)
+        scores = np.zeros(num_docs)
+        if not self.vocab or not self.total_len:
+            return scores
+
+        # Negative idfs are floored by a fraction of the average idf
+        doc_freqs = self.doc_freqs[:len(self.vocab)]
+        idf = np.log(num_docs - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+        idf = np.where(idf < 0, self.epsilon * idf.mean(), idf)
+        avgdl = self.total_len / num_docs
+        doc_lens = self.doc_lens[:num_docs]
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lens / avgdl)
+
+        for term, count in Counter(tokenized_query).items():
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            doc_ids = np.array(self.postings[term_id][0])
+            freqs = np.array(self.postings[term_id][1])
+            scores[doc_ids] += count * idf[term_id] * (
+                freqs * (self.k1 + 1) / (freqs + length_norm[doc_ids])
+            )
+        return scores
+
+
+_RETRIEVERS: "OrderedDict[str, BM25Retriever]" = OrderedDict()
+_RETRIEVERS_LOCK = threading.Lock()
+
+
+def get_retriever(key: Optional[str], documents: List[str]) -> BM25Retriever:
+    """Get the retriever of a run, synced with its retrieved documents.
+
+    Documents only grow during a run, so the cached retriever of the run
+    indexes the new documents only. It is rebuilt when documents do not
+    extend what it has indexed. Without a run key, nothing is cached.
+    """
+    if key is None:
+        retriever = BM25Retriever()
+        retriever.add_documents(documents)
+        return retriever
+    with _RETRIEVERS_LOCK:
+        retriever = _RETRIEVERS.get(key)
+        num_docs = 0 if retriever is None else len(retriever.docs)
+        if (
+            retriever is None
+            or num_docs > len(documents)
+            or (num_docs and retriever.docs[-1] != documents[num_docs - 1])
+        ):
+            retriever, num_docs = BM25Retriever(), 0
+        retriever.add_documents(documents[num_docs:])
+        _RETRIEVERS[key] = retriever
+        _RETRIEVERS.move_to_end(key)
+        while len(_RETRIEVERS) > RETRIEVER_CACHE_SIZE:
+            _RETRIEVERS.popitem(last=False)
+    return retriever
@@ -0,0 +1,101 @@
+"""Work queue shared by worker processes and nodes."""
+
+import time
+from typing import Dict, Iterable, List, Optional
+
+from webthinker.cache import SQLiteStore
+from webthinker.config import QUEUE_LEASE, QUEUE_MAX_ATTEMPTS
+
+
+class WorkQueue(SQLiteStore):
+    """SQLite work queue of task ids with leases.
+
+    Workers claim a task for ``lease`` seconds and renew the lease with
+    heartbeats while working on it. Tasks whose lease expired, e.g. as
+    their worker died, are claimed again. Failed tasks are retried until
+    they were claimed ``max_attempts`` times.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS tasks ("
+        "id INTEGER PRIMARY KEY, status TEXT, worker TEXT, "
+        "lease_until REAL, attempts INTEGER);"
+        "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);"
+    )
+
+    def __init__(
+        self,
+        path: str,
+        lease: float = QUEUE_LEASE,
+        max_attempts: int = QUEUE_MAX_ATTEMPTS,
+    ):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        super().__init__(path)
+
+    def add(self, ids: Iterable[int]):
+        """Add tasks, ignoring those already in the queue."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks VALUES (?, 'pending', NULL, 0, 0)",
+                [(task_id,) for task_id in ids],
+            )
+
+    def claim(self, worker: str, ids: List[int]) -> Optional[int]:
+        """Claim a pending or stale task among ids, None if there is none."""
+        if not ids:
+            return None
+        now = time.time()
+        placeholders = ",".join("?" * len(ids))
+        with self.transaction() as conn:
+            row = conn.execute(
+                f"SELECT id FROM tasks WHERE id IN ({placeholders}) "
+                f"AND attempts < ? AND (status = 'pending' "
+                f"OR (status = 'leased' AND lease_until < ?)) "
+                f"ORDER BY attempts, id LIMIT 1",
+                [*ids, self.max_attempts, now],
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, "
+                "lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now + self.lease, row[0]),
+            )
+        return row[0]
+
+    def heartbeat(self, worker: str, task_id: int) -> bool:
+        """Renew the lease of a task, False if the worker lost it."""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET lease_until = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (time.time() + self.lease, task_id, worker),
+            )
+        return cursor.rowcount > 0
+
+    def complete(self, worker: str, task_id: int):
+        """Mark a task as done."""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = 'done', lease_until = 0 "
+                "WHERE id = ? AND worker = ?",
+                (task_id, worker),
+            )
+
+    def fail(self, worker: str, task_id: int):
+        """Release a failed task for a retry, or give it up."""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET lease_until = 0, status = CASE "
+                "WHEN attempts < ? THEN 'pending' ELSE 'failed' END "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (self.max_attempts, task_id, worker),
+            )
+
+    def counts(self) -> Dict[str, int]:
+        """Count tasks by status."""
+        rows = self.conn.execute(
+            "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+        ).fetchall()
+        return dict(rows)
@@ -0,0 +1,72 @@
+"""Tests of the incremental BM25 retriever."""
+
+import random
+
+import numpy as np
+import pytest
+from rank_bm25 import BM25Okapi
+
+from webthinker import utils
+from webthinker.utils import BM25Retriever, get_retriever
+
+WORDS = [f"w{i}" for i in range(30)]
+
+
+def random_doc(rng):
+    """Document of random words from a small vocabulary."""
+    return " ".join(rng.choices(WORDS, k=rng.randint(1, 20)))
+
+
+@pytest.fixture(autouse=True)
+def fixture_tokenizer(monkeypatch):
+    """Tokenize on whitespace, as punkt is not available offline."""
+    monkeypatch.setattr(utils, "word_tokenize", str.split)
+
+
+def test_scores_match_bm25_okapi():
+    rng = random.Random(0)
+    for _ in range(50):
+        retriever = BM25Retriever()
+        docs = []
+        # Documents are added in several batches
+        for _ in range(rng.randint(1, 4)):
+            batch = [random_doc(rng) for _ in range(rng.randint(1, 10))]
+            retriever.add_documents(batch)
+            docs.extend(batch)
+            expected = BM25Okapi([doc.split() for doc in docs])
+            for _ in range(5):
+                query = rng.choices(WORDS + ["unknown"], k=rng.randint(1, 5))
+                np.testing.assert_allclose(
+                    retriever.get_scores(query), expected.get_scores(query), atol=1e-9,
+                )
+
+
+def test_invoke_returns_top_documents():
+    retriever = BM25Retriever()
+    assert retriever.invoke("w1") == []
+    docs = ["w1 w2", "w3 w4", "w1 w1 w5", "w6"]
+    retriever.add_documents(docs)
+    scores = BM25Okapi([doc.split() for doc in docs]).get_scores(["w1"])
+    expected = [docs[i] for i in np.argsort(-scores, kind="stable")[:2]]
+    assert retriever.invoke("w1", k=2) == expected
+    assert len(retriever.invoke("w1", k=10)) == len(docs)
+
+
+def test_get_retriever_indexes_new_documents_only(monkeypatch):
+    monkeypatch.setattr(utils, "_RETRIEVERS", type(utils._RETRIEVERS)())
+    retriever = get_retriever("run", ["w1", "w2"])
+    assert get_retriever("run", ["w1", "w2", "w3"]) is retriever
+    assert retriever.docs == ["w1", "w2", "w3"]
+    # Documents not extending the indexed ones rebuild the retriever
+    rebuilt = get_retriever("run", ["w4"])
+    assert rebuilt is not retriever and rebuilt.docs == ["w4"]
+
+
+def test_runs_have_their_own_retrievers(monkeypatch):
+    monkeypatch.setattr(utils, "_RETRIEVERS", type(utils._RETRIEVERS)())
+    first = get_retriever("run1", ["w1"])
+    second = get_retriever("run2", ["w1", "w2"])
+    assert first is not second and first.docs == ["w1"]
+    # Runs without a key never share a retriever
+    assert get_retriever(None, ["w1"]) is not get_retriever(None, ["w1", "w2"])
+    assert None not in utils._RETRIEVERS
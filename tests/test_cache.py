@@ -0,0 +1,59 @@
+"""Tests of the persistent caches."""
+
+import asyncio
+import os
+
+from webthinker import cache, utils
+from webthinker.cache import BlobStore, PageStore, content_digest
+
+
+def random_content() -> str:
+    """Incompressible page content."""
+    return os.urandom(2000).hex()
+
+
+def test_blobs_are_evicted_with_their_pages(tmp_path):
+    page_store = PageStore(str(tmp_path / "pages.sqlite"), max_bytes=3000)
+    blob_store = BlobStore(page_store, memory_bytes=0)
+    old, new = random_content(), random_content()
+    page_store.put("https://example.com/old", old)
+    assert blob_store.get(content_digest(old)) == old
+
+    page_store.put("https://example.com/new", new)
+    assert blob_store.get(content_digest(old)) is None
+    assert blob_store.get(content_digest(new)) == new
+    # Contents are stored once, in the page rows
+    assert page_store.conn.execute("SELECT COUNT(*) FROM pages").fetchone() == (1,)
+
+
+def test_evicted_contents_are_fetched_again(tmp_path, monkeypatch):
+    page_store = PageStore(str(tmp_path / "pages.sqlite"))
+    monkeypatch.setattr(cache, "_BLOB_STORE", BlobStore(page_store, memory_bytes=0))
+    content = random_content()
+    fetched = []
+
+    async def fake_afetch_contents(urls):
+        fetched.extend(urls)
+        return {url: content for url in urls}
+
+    monkeypatch.setattr(utils, "afetch_contents", fake_afetch_contents)
+    url = "https://example.com/page"
+    contents = asyncio.run(utils.aload_contents({url: content_digest(content)}))
+    assert contents == {url: content}
+    assert fetched == [url]
+
+
+def test_stored_pages_do_not_start_the_crawler(tmp_path, monkeypatch):
+    page_store = PageStore(str(tmp_path / "pages.sqlite"))
+    monkeypatch.setattr(cache, "_PAGE_STORE", page_store)
+    monkeypatch.setattr(
+        cache, "_FAILURE_CACHE", cache.FailureCache(str(tmp_path / "failures.sqlite")),
+    )
+
+    def get_crawler_pool():
+        raise AssertionError("The crawler pool was started.")
+
+    monkeypatch.setattr(utils, "get_crawler_pool", get_crawler_pool)
+    url = "https://example.com/page"
+    page_store.put(url, "stored")
+    assert asyncio.run(utils.afetch_contents([url, url])) == {url: "stored"}
@@ -0,0 +1,67 @@
+"""Tests of history compaction."""
+
+from langchain_core.messages import (AIMessage, HumanMessage, SystemMessage,
+                                     ToolMessage)
+
+from webthinker.config import COMPACTED_TOOL_OUTPUT_CHARS
+from webthinker.utils import compact_history, estimate_tokens
+
+NUDGE = "Please continue."
+
+
+def make_history(outputs):
+    """Build a history with one tool call per output."""
+    messages = [HumanMessage("question", id="0")]
+    for i, output in enumerate(outputs):
+        call = {"name": "search", "args": {"query": str(i)}, "id": f"call{i}"}
+        messages.append(AIMessage("", id=f"ai{i}", tool_calls=[call]))
+        messages.append(ToolMessage(output, id=f"tool{i}", tool_call_id=f"call{i}"))
+    return messages
+
+
+def test_within_budget_is_unchanged():
+    messages = make_history(["x" * 2000] * 3)
+    compacted, before, after = compact_history(messages, NUDGE, 10 ** 6, 2)
+    assert compacted == messages
+    assert before == after
+
+
+def test_drops_repeated_nudges():
+    messages = make_history(["a"])
+    messages += [SystemMessage(NUDGE), AIMessage("b"), SystemMessage(NUDGE)]
+    compacted, _, _ = compact_history(messages, NUDGE, 10 ** 6, 2)
+    nudges = [m for m in compacted if m.content == NUDGE]
+    assert len(nudges) == 1 and compacted[-1].content == NUDGE
+
+
+def test_truncates_then_omits_old_outputs():
+    messages = make_history(["x" * 4000] * 4)
+    budget = sum(estimate_tokens(m) for m in messages) - 1500
+    compacted, before, after = compact_history(messages, NUDGE, budget, 2)
+    assert after <= budget < before
+    assert compacted[2].text().endswith("...[truncated]")
+    assert len(compacted[2].text()) < 4000
+    # The recent messages are kept verbatim
+    assert compacted[-2:] == messages[-2:]
+
+    compacted, _, after = compact_history(messages, NUDGE, 200, 2)
+    assert compacted[2].text() == "[Output omitted to save context.]"
+    assert compacted[-2:] == messages[-2:]
+
+
+def test_never_lengthens_short_outputs():
+    short = "y" * (COMPACTED_TOOL_OUTPUT_CHARS // 2)
+    messages = make_history([short] * 4 + ["x" * 4000])
+    _, before, after = compact_history(messages, NUDGE, 1, 2)
+    assert after <= before
+    tiny = make_history(["ok"] * 4)
+    compacted, _, _ = compact_history(tiny, NUDGE, 1, 1)
+    assert [m.text() for m in compacted] == [m.text() for m in tiny]
+
+
+def test_keep_recent_zero_compacts_all_outputs():
+    messages = make_history(["x" * 4000] * 2)
+    compacted, _, _ = compact_history(messages, NUDGE, 1, 0)
+    assert compacted[-1].text() == "[Output omitted to save context.]"
+    # The first message is always kept
+    assert compacted[0] == messages[0]
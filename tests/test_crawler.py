@@ -0,0 +1,115 @@
+"""Tests of the crawler pool."""
+
+import asyncio
+
+import httpx
+
+from webthinker import crawler
+from webthinker.crawler import FETCH_FAILED, CrawlerPool
+
+
+def make_pool(fetch_page, max_per_host=2):
+    """Pool fetching pages with fetch_page, without warming up browsers."""
+    pool = CrawlerPool(max_per_host=max_per_host)
+    pool._global_limit = asyncio.Semaphore(10)  # pylint: disable=protected-access
+    pool.fetch_page = fetch_page
+    return pool
+
+
+def test_host_limits_are_bounded_and_dropped():
+    active, peak = {}, {}
+
+    async def fetch_page(url):
+        host = url.split("/")[2]
+        active[host] = active.get(host, 0) + 1
+        peak[host] = max(peak.get(host, 0), active[host])
+        await asyncio.sleep(0.01)
+        active[host] -= 1
+        if url.endswith("bad"):
+            raise RuntimeError("crashed")
+        return url
+
+    async def run():
+        pool = make_pool(fetch_page)
+        urls = [f"https://h{i}.com/{j}" for i in range(3) for j in range(5)]
+        contents = await pool.crawl_many(urls + ["https://h0.com/bad"], deadline=5)
+        assert contents["https://h0.com/bad"] == FETCH_FAILED
+        assert peak == {"h0.com": 2, "h1.com": 2, "h2.com": 2}
+        # Pages cancelled by the deadline release their hosts too
+        contents = await pool.crawl_many(["https://slow.com/1"], deadline=0.001)
+        assert contents == {"https://slow.com/1": None}
+        return pool
+
+    pool = asyncio.run(run())
+    assert not pool._host_limits   # pylint: disable=protected-access
+    assert not pool._host_users    # pylint: disable=protected-access
+
+
+class CountingStream(httpx.AsyncByteStream):
+    """Response body counting the bytes read from it."""
+
+    def __init__(self, data, chunk_size=1024):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.read = 0
+
+    async def __aiter__(self):
+        for i in range(0, len(self.data), self.chunk_size):
+            self.read += self.chunk_size
+            yield self.data[i:i + self.chunk_size]
+
+
+def http_fetch(content_type, stream, headers=None):
+    """Fetch a page served with a content type and a body."""
+    def handler(request):
+        return httpx.Response(
+            200, headers={"content-type": content_type, **(headers or {})},
+            stream=stream,
+        )
+
+    async def run():
+        pool = CrawlerPool()
+        pool._http = httpx.AsyncClient(    # pylint: disable=protected-access
+            transport=httpx.MockTransport(handler),
+        )
+        return await pool.http_fetch("https://example.com/page")
+    return asyncio.run(run())
+
+
+def test_http_fetch_reads_text_pages():
+    text = "word " * 200
+    assert http_fetch("text/plain; charset=utf-8", CountingStream(text.encode())) == text.strip()
+
+
+def test_http_fetch_skips_unsupported_types_unread():
+    stream = CountingStream(b"\x89PNG" + b"0" * 10000)
+    assert http_fetch("image/png", stream) is None
+    assert stream.read == 0
+
+
+def test_http_fetch_abandons_large_bodies(monkeypatch):
+    monkeypatch.setattr(crawler, "HTTP_MAX_BYTES", 4096)
+    stream = CountingStream(b"word " * 10000)
+    assert http_fetch("text/plain", stream) is None
+    assert stream.read <= 4096 + stream.chunk_size
+    # Declared sizes are checked before reading
+    stream = CountingStream(b"word " * 10000)
+    assert http_fetch("text/plain", stream, {"content-length": "50000"}) is None
+    assert stream.read == 0
+
+
+def test_pool_runs_work_before_browsers_start(monkeypatch):
+    started = []
+
+    async def start_crawler(self):
+        await asyncio.sleep(60)
+        started.append(self)
+
+    monkeypatch.setattr(CrawlerPool, "_start_crawler", start_crawler)
+    pool = CrawlerPool(size=1)
+    try:
+        assert pool.submit(asyncio.sleep(0, "done")).result(timeout=5) == "done"
+    finally:
+        pool.close()
+    # Closing the pool cancels the browsers still starting
+    assert not started
@@ -0,0 +1,112 @@
+"""Tests of the evaluation."""
+
+import threading
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+from webthinker import cache, evaluate
+from webthinker.config import JUDGE_MAX_RATE_LIMIT_RETRIES
+
+
+class FakeJudge:
+    """Fake judge model answering with a judgment or an error."""
+
+    name = "fake"
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = 0
+        self.inputs = []
+        self.max_concurrency = []
+
+    def with_structured_output(self, schema):
+        """Outputs are already structured."""
+        return self
+
+    def _get_llm_string(self):
+        return "fake"
+
+    def batch(self, inputs, config, return_exceptions):
+        """Answer each input."""
+        self.calls += 1
+        self.inputs.append(len(inputs))
+        self.max_concurrency.append(config["max_concurrency"])
+        return [self.answer() for _ in inputs]
+
+
+def rate_limit_error():
+    """Rate limit error of the API."""
+    request = httpx.Request("POST", "https://api.example.com")
+    response = httpx.Response(429, request=request)
+    return RateLimitError("Rate limited", response=response, body=None)
+
+
+@pytest.fixture(name="judge")
+def fixture_judge(tmp_path, monkeypatch):
+    """Isolate the judgment cache and skip backoffs."""
+    monkeypatch.setattr(
+        cache, "_JUDGMENT_CACHE", cache.JudgmentCache(str(tmp_path / "judgments.sqlite")),
+    )
+    monkeypatch.setattr(evaluate.time, "sleep", lambda seconds: None)
+
+    def set_judge(answer):
+        model = FakeJudge(answer)
+        monkeypatch.setattr(evaluate, "get_evaluation_model", lambda: model)
+        return model
+    return set_judge
+
+
+def test_judgments_are_cached(judge):
+    model = judge(lambda: {"justification": "Correct"})
+    assert evaluate.judge_answers(["q"], ["a"], ["a"]) == ["Correct"]
+    assert evaluate.judge_answers(["q"], ["a"], ["a"]) == ["Correct"]
+    assert model.calls == 1
+
+
+def test_rate_limit_retries_are_bounded(judge):
+    model = judge(rate_limit_error)
+    assert evaluate.judge_answers(["q"], ["a"], ["a"]) == ["Incorrect"]
+    assert model.calls == JUDGE_MAX_RATE_LIMIT_RETRIES + 1
+    # Concurrency is halved down to one on rate limits
+    assert model.max_concurrency[-1] == 1
+
+    # Judgments given up are not cached
+    model = judge(lambda: {"justification": "Correct"})
+    assert evaluate.judge_answers(["q"], ["a"], ["a"]) == ["Correct"]
+
+
+def test_streaming_judgments_are_batched(judge):
+    model = judge(lambda: {"justification": "Correct"})
+    evaluator = evaluate.StreamingEvaluator(llm_eval=True, max_concurrency=4)
+    # Keep the judging thread busy until all results are added
+    added = threading.Event()
+    evaluator._executor.submit(added.wait)  # pylint: disable=protected-access
+    for i in range(5):
+        evaluator.add({
+            "id": i, "question": f"q{i}", "label": "a", "pred": "a", "group": "1",
+        })
+    added.set()
+    performance = evaluator.finish()
+    assert performance["llm_score"]["overall"] == 1
+    assert model.calls == 1
+    assert model.inputs == [5]
+    assert model.max_concurrency == [4]
+
+
+def test_evaluate_without_results():
+    performance = evaluate.evaluate_qa([])
+    assert performance == {
+        metric: {"overall": 0, "group": {}} for metric in evaluate.QA_METRICS
+    }
+    assert performance == evaluate.StreamingEvaluator().performance()
+
+
+def test_evaluate_by_group():
+    results = [
+        {"id": 1, "question": "q", "label": "Paris", "pred": "paris", "group": "1"},
+        {"id": 2, "question": "q", "label": "Rome", "pred": "Milan", "group": "2"},
+    ]
+    performance = evaluate.evaluate_qa(results)
+    assert performance["exact_match"] == {"overall": 0.5, "group": {"1": 1, "2": 0}}
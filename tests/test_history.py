@@ -0,0 +1,39 @@
+"""Tests of history rendering."""
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from webthinker.utils import HistoryRenderer, history_prompt, render_message
+
+
+def render_all(messages):
+    """Render a history from scratch."""
+    return "\n".join(render_message(m) for m in messages)
+
+
+def test_renderer_matches_full_rendering():
+    renderer = HistoryRenderer()
+    call = {"name": "search", "args": {"query": "q"}, "id": "call"}
+    messages = [HumanMessage("question", id="0")]
+    for step in [
+        AIMessage("", id="1", tool_calls=[call]),
+        ToolMessage("results", id="2", tool_call_id="call"),
+        AIMessage("answer", id="3"),
+    ]:
+        messages.append(step)
+        assert renderer.render(messages) == render_all(messages)
+
+    # Messages edited in place under the same id are rendered again
+    messages[3] = AIMessage("edited answer", id="3")
+    assert renderer.render(messages) == render_all(messages)
+    # Truncated histories are rendered from their first difference
+    assert renderer.render(messages[:2]) == render_all(messages[:2])
+
+
+def test_prompts_share_the_history_as_prefix():
+    messages = [HumanMessage("question", id="0"), AIMessage("thought", id="1")]
+    first = history_prompt(messages, "Search intent?")
+    messages.append(AIMessage("another thought", id="2"))
+    second = history_prompt(messages, "Write the section.")
+    assert second[0].content.startswith(first[0].content.rstrip("\n"))
+    assert "question" in first[0].content and "another thought" in second[0].content
+    assert second[1].content == "Write the section."
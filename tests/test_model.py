@@ -0,0 +1,104 @@
+"""Tests of the LLM concurrency limit."""
+
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+
+from webthinker import model
+from webthinker.model import (AsyncLimitedTransport, ConcurrencyLimiter,
+                              LimitedTransport)
+
+
+@pytest.fixture(name="limiter")
+def fixture_limiter(monkeypatch):
+    """Shared limiter of two slots."""
+    limiter = ConcurrencyLimiter(2)
+    monkeypatch.setattr(model, "_LLM_LIMITER", limiter)
+    return limiter
+
+
+def test_threads_and_tasks_share_the_limit(limiter):
+    peak, lock = [0], threading.Lock()
+
+    def hold():
+        with lock:
+            peak[0] = max(peak[0], limiter.active)
+        time.sleep(0.01)
+        limiter.release()
+
+    def call():
+        limiter.acquire()
+        hold()
+
+    async def acall():
+        await limiter.aacquire()
+        await asyncio.to_thread(hold)
+
+    async def run():
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        await asyncio.gather(*(acall() for _ in range(4)))
+        for thread in threads:
+            thread.join()
+
+    asyncio.run(run())
+    assert peak[0] == 2 and limiter.active == 0
+
+
+def test_cancelled_waiters_free_their_turn(limiter):
+    async def run():
+        await limiter.aacquire()
+        await limiter.aacquire()
+        waiter = asyncio.ensure_future(limiter.aacquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        limiter.release()
+        # The next caller gets the freed slot right away
+        await asyncio.wait_for(limiter.aacquire(), timeout=1)
+
+    asyncio.run(run())
+    assert limiter.active == 2
+
+
+class Body(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """Response body streamed like the network ones."""
+
+    def __iter__(self):
+        yield b"chunk"
+
+    async def __aiter__(self):
+        yield b"chunk"
+
+
+def test_responses_hold_slots_until_closed(limiter):
+    def handler(request):
+        return httpx.Response(200, stream=Body())
+
+    async def arun():
+        client = httpx.AsyncClient(transport=AsyncLimitedTransport(httpx.MockTransport(handler)))
+        async with client.stream("GET", "https://llm.com/") as response:
+            assert limiter.active == 1
+            await response.aread()
+        assert limiter.active == 0
+        await client.get("https://llm.com/")
+        assert limiter.active == 0
+
+    asyncio.run(arun())
+    client = httpx.Client(transport=LimitedTransport(httpx.MockTransport(handler)))
+    with client.stream("GET", "https://llm.com/") as response:
+        assert limiter.active == 1
+    assert limiter.active == 0
+    # Streams wait for a slot until some response is closed
+    limiter.set_limit(1)
+    with client.stream("GET", "https://llm.com/"):
+        waiter = threading.Thread(target=client.get, args=("https://llm.com/",))
+        waiter.start()
+        waiter.join(timeout=0.1)
+        assert waiter.is_alive()
+    waiter.join(timeout=1)
+    assert not waiter.is_alive() and limiter.active == 0
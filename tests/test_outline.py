@@ -0,0 +1,50 @@
+"""Tests of incremental header indexing."""
+
+import pytest
+from mrkdwn_analysis import MarkdownAnalyzer
+
+from webthinker.utils import format_outline, index_headers
+
+
+def full_outline(article):
+    """Outline of a full parse of the article."""
+    headers = MarkdownAnalyzer.from_string(article).identify_headers().get("Header", [])
+    return "".join(f"{'#' * h['level']} {h['text']}\n" for h in headers)
+
+
+@pytest.mark.parametrize("sections", [
+    # Sections appended one by one
+    ["# Title\n", "Intro text.\n\n", "## Part 1\nBody.\n\n", "## Part 2\nBody.\n"],
+    # Text appended right after a header
+    ["# Title\n", "## Part", " 1\n", "more text\n", "### Sub\n"],
+    # Fenced code hides headers
+    ["## Code\n", "```\n# not a header\n```\n", "text\n```python\n# comment\n```\n", "## After\n"],
+    # Setext headers underline the text appended before
+    ["## First\n", "Title\n", "===\n", "Subtitle\n", "---\n", "text\n"],
+    # Thematic breaks after the last header
+    ["## Part\n", "text\n\n", "---\n", "## Next\n", "---\n\ntext\n"],
+    # Headers starting with "---" are not restarted from, as front matter
+    ["## Part\n", "---\n", "---\n", "## Next\n"],
+    # Lists, quotes and tables between headers
+    ["# A\n", "- item\n- item2\n", "> quote\n", "| a | b |\n|---|---|\n| 1 | 2 |\n", "## B\n"],
+])
+def test_incremental_matches_full_parse(sections):
+    article, headers = "", []
+    for section in sections:
+        article += section
+        headers = index_headers(article, headers)
+        assert format_outline(headers) == full_outline(article)
+
+
+def test_offsets_point_to_headers():
+    article = "# Title\nIntro.\n\n## Part 1\nBody.\n"
+    headers = index_headers(article)
+    assert [h["offset"] for h in headers] == [0, article.index("## Part 1")]
+    article += "## Part 2\n"
+    headers = index_headers(article, headers)
+    assert headers[-1] == {"offset": article.index("## Part 2"), "level": 2, "text": "Part 2"}
+
+
+def test_empty_article():
+    assert not index_headers("")
+    assert format_outline([]) == ""
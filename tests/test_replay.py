@@ -0,0 +1,110 @@
+"""Tests of record and replay."""
+
+import asyncio
+
+import pytest
+from langchain_core.globals import set_llm_cache
+from langchain_core.language_models.fake_chat_models import \
+    GenericFakeChatModel
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage
+
+from webthinker import cache, graph, replay, utils
+from webthinker.crawler import FETCH_FAILED
+
+
+class FakeChatModel(GenericFakeChatModel):
+    """Fake chat model answering with the given messages."""
+
+    def bind_tools(self, tools, **kwargs):
+        """Tools are ignored by the fake model."""
+        return self
+
+
+class FakeCrawlerPool:
+    """Fake crawler pool failing to fetch any page."""
+
+    async def afetch_many(self, urls):
+        """Fail all pages."""
+        return {url: FETCH_FAILED for url in urls}
+
+
+@replay.replayable("search")
+async def fake_search(query, max_results):
+    """Fake search returning one result."""
+    return [{
+        "id": 1,
+        "title": query,
+        "url": f"https://example.com/{query}",
+        "snippet": query,
+        "content": "",
+    }][:max_results]
+
+
+def tool_call(name, args):
+    """AI message calling a tool."""
+    return AIMessage("", tool_calls=[{"name": name, "args": args, "id": f"call_{name}"}])
+
+
+@pytest.fixture(name="stores")
+def fixture_stores(tmp_path, monkeypatch):
+    """Isolate the stores and the archive of the process."""
+    monkeypatch.setattr(cache, "_PAGE_STORE", cache.PageStore(str(tmp_path / "pages.sqlite")))
+    monkeypatch.setattr(cache, "_BLOB_STORE", cache.BlobStore(cache._PAGE_STORE))
+    monkeypatch.setattr(
+        cache, "_FAILURE_CACHE", cache.FailureCache(str(tmp_path / "failures.sqlite")),
+    )
+    monkeypatch.setattr(graph, "search_google_serper", fake_search)
+    monkeypatch.setattr(utils, "get_crawler_pool", FakeCrawlerPool)
+    yield tmp_path
+    monkeypatch.setattr(replay, "_ARCHIVE", None)
+    set_llm_cache(None)
+
+
+def run_agent(monkeypatch, supervisor_messages, writer_messages):
+    """Run the solution agent with fake models."""
+    supervisor = FakeChatModel(messages=iter(supervisor_messages))
+    writer = FakeChatModel(messages=iter(writer_messages))
+    monkeypatch.setattr(graph, "get_supervisor_model", lambda: supervisor)
+    monkeypatch.setattr(graph, "get_writer_model", lambda: writer)
+    return asyncio.run(graph.webthinker().ainvoke(
+        {"research_question": "What is the answer?", "log_file": None},
+        {"recursion_limit": 20},
+    ))
+
+
+def test_record_replay_round_trip(stores, monkeypatch):
+    """A recorded run replays without calling models, search or fetch."""
+    path = str(stores / "archive.sqlite")
+
+    replay.enable_archive(path, "record")
+    recorded = run_agent(
+        monkeypatch,
+        [
+            tool_call("search_query", {"query": "answer"}),
+            tool_call("research_complete", {"final_answer": "42"}),
+        ],
+        ["Find the answer.", "The answer is 42."],
+    )
+    assert recorded["solution"] == "42"
+
+    # Replayed models have no response left, so any unreplayed call fails
+    replay.enable_archive(path, "replay")
+    monkeypatch.setattr(utils, "get_crawler_pool", None)
+    replayed = run_agent(monkeypatch, [], [])
+    assert replayed == recorded
+
+
+def test_llm_call_key_ignores_message_ids():
+    """Message ids differ in every run and are not part of the key."""
+    first = AIMessage("hi", id="run-1", tool_calls=[{"name": "t", "args": {}, "id": "call_1"}])
+    second = AIMessage("hi", id="run-2", tool_calls=[{"name": "t", "args": {}, "id": "call_1"}])
+    other = AIMessage("bye", id="run-1")
+    assert (
+        replay.llm_call_key(dumps([first]), "llm")
+        == replay.llm_call_key(dumps([second]), "llm")
+    )
+    assert (
+        replay.llm_call_key(dumps([first]), "llm")
+        != replay.llm_call_key(dumps([other]), "llm")
+    )
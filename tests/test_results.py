@@ -0,0 +1,39 @@
+"""Tests of result files and resume."""
+
+import json
+
+from webthinker.evaluate import load_results
+from webthinker.run import append_result
+
+
+def test_missing_results_are_empty(tmp_path):
+    assert load_results(str(tmp_path / "results.jsonl")) == []
+
+
+def test_load_json_results(tmp_path):
+    path = tmp_path / "results.json"
+    path.write_text(json.dumps([{"id": 1}, {"id": 2}]), encoding="utf-8")
+    assert load_results(str(path)) == [{"id": 1}, {"id": 2}]
+
+
+def test_last_record_of_a_task_wins(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    append_result(path, {"id": 1, "pred": "", "error": "timeout"})
+    append_result(path, {"id": 2, "pred": "b", "error": None})
+    append_result(path, {"id": 1, "pred": "a", "error": None})
+    results = load_results(path)
+    assert sorted(result["id"] for result in results) == [1, 2]
+    assert {result["id"]: result["pred"] for result in results} == {1: "a", 2: "b"}
+
+
+def test_resume_after_torn_line(tmp_path):
+    path = tmp_path / "results.jsonl"
+    append_result(str(path), {"id": 1, "pred": "a"})
+    # Simulate a crash in the middle of a write
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"id": 2, "pr')
+    assert [result["id"] for result in load_results(str(path))] == [1]
+
+    append_result(str(path), {"id": 3, "pred": "c"})
+    assert [result["id"] for result in load_results(str(path))] == [1, 3]
+    assert path.read_text(encoding="utf-8").endswith('{"id": 3, "pred": "c"}\n')
@@ -0,0 +1,83 @@
+"""Tests of snippet matching with sentence indexes."""
+
+import random
+import string
+
+import pytest
+from nltk.tokenize.punkt import PunktSentenceTokenizer
+
+from webthinker import cache, utils
+from webthinker.utils import SentenceIndex
+
+WORDS = ["apple", "Banana", "cherry", "date", "elder", "fig", "grape", "kiwi"]
+
+
+def f1_score(true_set, pred_set):
+    """F1 score of two sets, as the original matcher computed it."""
+    intersection = true_set.intersection(pred_set)
+    if intersection:
+        p = len(intersection) / len(pred_set)
+        r = len(intersection) / len(true_set)
+        return 2 * p * r / (p + r)
+    return 0.
+
+
+def sentence_f1s(content, snippet):
+    """F1 of the snippet with each sentence, by the original matcher."""
+    tokenizer = PunktSentenceTokenizer()
+    snippet_words = utils.bag_of_words(snippet)
+    return [
+        f1_score(snippet_words, utils.bag_of_words(
+            sent.translate(str.maketrans("", "", string.punctuation))
+        ))
+        for sent in tokenizer.tokenize(content)
+    ]
+
+
+def random_sentence(rng):
+    """Sentence of a few random words and punctuation."""
+    words = rng.choices(WORDS, k=rng.randint(1, 8))
+    return " ".join(words).capitalize() + rng.choice([".", "!", "?", ", well."])
+
+
+@pytest.fixture(autouse=True)
+def fixture_tokenizer(tmp_path, monkeypatch):
+    """Use an untrained punkt tokenizer and an isolated page store."""
+    monkeypatch.setattr(utils, "get_sentence_tokenizer", PunktSentenceTokenizer)
+    monkeypatch.setattr(cache, "_PAGE_STORE", cache.PageStore(str(tmp_path / "pages.sqlite")))
+    monkeypatch.setattr(utils, "_SENTENCE_INDEXES", type(utils._SENTENCE_INDEXES)())
+
+
+def test_best_span_matches_original_f1():
+    rng = random.Random(0)
+    for _ in range(300):
+        content = " ".join(random_sentence(rng) for _ in range(rng.randint(0, 12)))
+        snippet = " ".join(rng.choices(WORDS, k=rng.randint(0, 5)))
+        f1s = sentence_f1s(content, snippet)
+        best_f1 = max(f1s, default=0.)
+        span = SentenceIndex.build(content).best_span(snippet)
+        if best_f1 <= 0.2 + 1e-9:
+            assert span is None or best_f1 == pytest.approx(0.2)
+            continue
+        assert span is not None
+        spans = list(PunktSentenceTokenizer().span_tokenize(content))
+        assert f1s[spans.index(span)] == pytest.approx(best_f1)
+
+
+def test_serialized_index_matches():
+    content = "The cat sat. A dog barked loudly! Birds sing in the morning."
+    index = SentenceIndex.build(content)
+    restored = SentenceIndex.from_bytes(index.to_bytes())
+    for snippet in ["dog barked", "birds morning", "nothing here"]:
+        assert restored.best_span(snippet) == index.best_span(snippet)
+    assert index.best_span("dog barked") == (13, 33)
+
+
+def test_extract_context_by_snippet():
+    content = "First sentence here. " * 3 + "The answer is forty two. " + "Filler. " * 3
+    context = utils.extract_context_by_snippet(content, "answer forty two", context_chars=10)
+    # As originally, the context starts context_chars before the sentence
+    # and spans the length of the sentence plus context_chars
+    assert context == content[63 - 10:63 - 10 + len("The answer is forty two.") + 10]
+    # Unmatched snippets fall back to the head of the page
+    assert utils.extract_context_by_snippet(content, "zebra", context_chars=10) == content[:20]
@@ -0,0 +1,80 @@
+"""Tests of the work queue."""
+
+import asyncio
+import time
+
+from webthinker import run
+from webthinker.workqueue import WorkQueue
+
+
+def make_queue(tmp_path, **kwargs) -> WorkQueue:
+    """Queue with three tasks."""
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), **kwargs)
+    queue.add([1, 2, 3])
+    return queue
+
+
+def test_claims_each_task_once(tmp_path):
+    queue = make_queue(tmp_path)
+    claimed = [queue.claim("a", [1, 2, 3]), queue.claim("b", [1, 2, 3])]
+    assert claimed == [1, 2]
+    assert queue.claim("a", [1, 2]) is None
+    assert queue.claim("a", []) is None
+    # Adding tasks again keeps their state
+    queue.add([1, 2, 3])
+    assert queue.counts() == {"leased": 2, "pending": 1}
+
+
+def test_complete_and_counts(tmp_path):
+    queue = make_queue(tmp_path)
+    task_id = queue.claim("a", [1, 2, 3])
+    # Only the owner completes its task
+    queue.complete("b", task_id)
+    assert queue.counts() == {"leased": 1, "pending": 2}
+    queue.complete("a", task_id)
+    assert queue.counts() == {"done": 1, "pending": 2}
+    assert queue.claim("b", [task_id]) is None
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    queue = make_queue(tmp_path, lease=0.1)
+    assert queue.claim("a", [1]) == 1
+    assert queue.heartbeat("a", 1)
+    assert queue.claim("b", [1]) is None
+    time.sleep(0.2)
+    assert queue.claim("b", [1]) == 1
+    # The dead worker lost its lease
+    assert not queue.heartbeat("a", 1)
+    assert queue.heartbeat("b", 1)
+
+
+def test_failed_tasks_retry_up_to_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    for _ in range(2):
+        assert queue.claim("a", [1]) == 1
+        queue.fail("a", 1)
+    assert queue.claim("a", [1]) is None
+    assert queue.counts() == {"failed": 1, "pending": 2}
+
+
+def test_lost_leases_drop_their_tasks(tmp_path, monkeypatch):
+    cancelled = []
+
+    async def solve_task(agent, task, output_dir, dataset):
+        if task["id"] == 1:
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(task["id"])
+                raise
+        return {"id": task["id"], "error": None}
+
+    monkeypatch.setattr(run, "webthinker", lambda checkpointer: None)
+    monkeypatch.setattr(run, "solve_task", solve_task)
+    queue = make_queue(tmp_path, lease=0.03)
+    # Another worker takes task 1 over
+    monkeypatch.setattr(queue, "heartbeat", lambda worker, task_id: task_id != 1)
+    tasks = [{"id": i} for i in [1, 2, 3]]
+    results = asyncio.run(run.solve_tasks(tasks, str(tmp_path), "gaia", queue=queue))
+    assert [result["id"] for result in results] == [2, 3] and cancelled == [1]
+    assert queue.counts() == {"leased": 1, "done": 2}